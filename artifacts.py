@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+from audio import MonoAudioFile
+
+# the stages in the order they depend on each other, with the extension of their files
+STAGES = (("pcm", ".pcm"), ("mask", ".npy"), ("timestamps", ".json"), ("intervals", ".json"),
+          ("transcripts", ".json"))
+
+# the media files are hashed from this many blocks of this size, spread over the file
+HASH_BLOCKS = 64
+HASH_BLOCK_SIZE = 64 * 1024
+
+class ArtifactStore:
+    """
+    Class used for keeping the output of every stage for every media file
+
+    The artifacts of a media file are kept in a directory named after the
+    hash of its content. Every artifact is keyed by the key of the stage
+    before it and by the parameters of its own stage, so changing a
+    parameter only invalidates the stages from that one on, and the
+    earlier artifacts are used again.
+    """
+    def __init__(self, root):
+        """
+        Parameters:
+        -----------
+        root : str
+            The directory of the store
+        """
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def media_hash(self, media_file) -> str:
+        """
+        Hashes the content of a media file
+
+        Only the size and HASH_BLOCKS blocks spread evenly over the file
+        are hashed, the start and the end included, so a film is not read
+        in full before its first subtitle. Two encodes of a film differ in
+        every block. The hash is remembered for the path, size and
+        modification time of the file, so a file is only read once.
+
+        Parameters:
+        -----------
+        media_file : str
+            The media file
+
+        Returns:
+        --------
+        str : the hash
+        """
+        stat = os.stat(media_file)
+        signature = "%s:%d:%d" % (os.path.abspath(media_file), stat.st_size, stat.st_mtime_ns)
+        index_file = os.path.join(self.root, "index.json")
+
+        with self._lock:
+            index = _read_json(index_file) or {}
+            if signature in index:
+                return index[signature]
+
+        h = hashlib.sha256(str(stat.st_size).encode())
+        with open(media_file, "rb") as f:
+            if stat.st_size <= HASH_BLOCKS * HASH_BLOCK_SIZE:
+                h.update(f.read())
+            else:
+                step = (stat.st_size - HASH_BLOCK_SIZE) / (HASH_BLOCKS - 1)
+                for i in range(HASH_BLOCKS):
+                    f.seek((int) (i * step))
+                    h.update(f.read(HASH_BLOCK_SIZE))
+        digest = h.hexdigest()[:32]
+
+        with self._lock:
+            index = _read_json(index_file) or {}
+            index[signature] = digest
+            _write_json(index_file, index)
+
+        return digest
+
+    def keys(self, media_file, params) -> dict:
+        """
+        Builds the key of every stage
+
+        Parameters:
+        -----------
+        media_file : str
+            The media file
+        params : dict
+            The parameters of every stage, by stage
+
+        Returns:
+        --------
+        dict : the key of every stage
+        """
+        keys = {}
+        key = self.media_hash(media_file)
+        for stage, _ in STAGES:
+            h = hashlib.sha256(key.encode())
+            h.update(stage.encode())
+            h.update(json.dumps(params.get(stage, {}), sort_keys=True).encode())
+            key = h.hexdigest()[:16]
+            keys[stage] = key
+
+        return keys
+
+    def path(self, media_file, stage, key) -> str:
+        """
+        Returns:
+        --------
+        str : the file of an artifact
+        """
+        directory = os.path.join(self.root, self.media_hash(media_file))
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, stage + "-" + key + dict(STAGES)[stage])
+
+    def load(self, media_file, stage, key):
+        """
+        Loads an artifact
+
+        Parameters:
+        -----------
+        media_file : str
+            The media file
+        stage : str
+            The stage
+        key : str
+            The key of the artifact
+
+        Returns:
+        --------
+        the artifact or None if it is not stored. The pcm audio is a
+        MonoAudioFile mapped in memory, the mask an ndarray and the rest
+        lists.
+        """
+        file_name = self.path(media_file, stage, key)
+        if not os.path.exists(file_name):
+            return None
+
+        if stage == "pcm":
+            audio = MonoAudioFile(file_name)
+            if os.path.getsize(file_name) == 0:
+                audio.load(16000, np.zeros(0, dtype=np.int16))
+            else:
+                audio.load(16000, np.memmap(file_name, dtype=np.int16, mode="r"))
+            return audio
+        if stage == "mask":
+            return np.load(file_name)
+        return _read_json(file_name)
+
+    def save(self, media_file, stage, key, artifact) -> None:
+        """
+        Stores an artifact, the pcm audio is stored with move_pcm instead
+
+        Parameters:
+        -----------
+        media_file : str
+            The media file
+        stage : str
+            The stage
+        key : str
+            The key of the artifact
+        artifact : ndarray or list
+            The output of the stage
+        """
+        file_name = self.path(media_file, stage, key)
+        if stage == "mask":
+            with open(file_name + ".part", "wb") as f:
+                np.save(f, artifact)
+            os.replace(file_name + ".part", file_name)
+        else:
+            _write_json(file_name, artifact)
+
+    def move_pcm(self, media_file, key, pcm_file) -> None:
+        """
+        Stores the 16 kHz mono audio, written as raw int16 samples
+
+        Parameters:
+        -----------
+        media_file : str
+            The media file
+        key : str
+            The key of the artifact
+        pcm_file : str
+            The raw audio file, moved into the store
+        """
+        os.replace(pcm_file, self.path(media_file, "pcm", key))
+
+    def audio_seconds(self, media_file) -> float:
+        """
+        Returns:
+        --------
+        float : the length of the stored 16 kHz audio of a media file, 0 if
+        there is none
+        """
+        directory = os.path.join(self.root, self.media_hash(media_file))
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            if name.startswith("pcm-") and name.endswith(".pcm"):
+                return os.path.getsize(os.path.join(directory, name)) / 2 / 16000
+        return 0
+
+def _read_json(file_name):
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_json(file_name, value) -> None:
+    # written to another file first, so a crash never leaves half an artifact
+    temp_file = "%s.%d.%d.part" % (file_name, os.getpid(), threading.get_ident())
+    with open(temp_file, "w") as f:
+        json.dump(value, f)
+    os.replace(temp_file, file_name)
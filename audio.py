@@ -1,8 +1,183 @@
+import os
+import struct
+import subprocess
+import threading
 import wave
-import librosa
+from math import gcd
 import numpy as np
-import soundfile as sf
 from scipy.io import wavfile
+from scipy.signal import resample_poly
+from metrics import METRICS
+
+def resample(samples, osr, tsr) -> np.ndarray:
+    """
+    Resamples int16 audio with a polyphase filter
+
+    Parameters:
+    -----------
+    samples : ndarray
+        The mono samples
+    osr: int
+        The original sample rate
+    tsr: int
+        The target sample rate
+
+    Returns:
+    --------
+    ndarray : the resampled int16 samples
+    """
+    if osr == tsr:
+        return np.asarray(samples, dtype=np.int16)
+
+    factor = gcd(osr, tsr)
+    with METRICS.span("resample"):
+        y = resample_poly(np.asarray(samples, dtype=np.float32), tsr // factor, osr // factor)
+        return _to_int16(y)
+
+def resample_chunks(chunks, osr, tsr):
+    """
+    Resamples a stream of int16 chunks with a polyphase filter
+
+    The chunks are resampled with enough context on each side that the
+    output is the same as resample() on the whole signal.
+
+    Parameters:
+    -----------
+    chunks : iterable
+        The mono sample chunks
+    osr: int
+        The original sample rate
+    tsr: int
+        The target sample rate
+
+    Yields:
+    -------
+    ndarray : the resampled int16 samples
+    """
+    if osr == tsr:
+        for chunk in chunks:
+            yield np.asarray(chunk, dtype=np.int16)
+        return
+
+    factor = gcd(osr, tsr)
+    up = tsr // factor
+    down = osr // factor
+
+    # context on each side, longer than half of the resample_poly filter and
+    # a multiple of down so that every chunk starts on an output sample
+    context = -(-10 * max(up, down) // up) + 1
+    pad = down * -(-context // down)
+    pad_out = pad * up // down
+
+    # the signal is zero before its start, like in resample_poly
+    buffer = np.zeros(pad, dtype=np.float32)
+    n_in = 0
+    n_out = 0
+
+    for chunk in chunks:
+        buffer = np.concatenate((buffer, np.asarray(chunk, dtype=np.float32)))
+        n_in += len(chunk)
+
+        usable = ((len(buffer) - 2 * pad) // down) * down
+        if usable <= 0:
+            continue
+
+        with METRICS.span("resample"):
+            y = resample_poly(buffer[:usable + 2 * pad], up, down)
+        out = y[pad_out:pad_out + usable * up // down]
+        n_out += len(out)
+        buffer = buffer[usable:]
+        yield _to_int16(out)
+
+    remaining = -(-n_in * up // down) - n_out
+    if remaining > 0:
+        buffer = np.concatenate((buffer, np.zeros(pad, dtype=np.float32)))
+        y = resample_poly(buffer, up, down)
+        yield _to_int16(y[pad_out:pad_out + remaining])
+
+def downmix(channels, block_frames=1 << 16) -> np.ndarray:
+    """
+    Averages the channels into mono samples
+
+    The average is computed in integers, block by block, and rounded
+    towards zero, so only the output is as long as the input.
+
+    Parameters:
+    -----------
+    channels : ndarray
+        The channel data, one channel per row
+    block_frames : int
+        The number of frames averaged at once
+
+    Returns:
+    --------
+    ndarray : the mono samples
+    """
+    if channels.shape[0] == 1:
+        # already mono, as the 16 kHz audio of the speech detection
+        return np.asarray(channels[0], dtype=np.int16)
+
+    n_channels, n_frames = channels.shape
+    with METRICS.span("downmix"):
+        mono = np.empty(n_frames, dtype=np.int16)
+        for start in range(0, n_frames, block_frames):
+            total = channels[:, start:start + block_frames].sum(axis=0, dtype=np.int32)
+            # the negative sums are rounded up, so the result goes towards zero
+            total += (n_channels - 1) * (total < 0)
+            total //= n_channels
+            mono[start:start + block_frames] = total
+
+        return mono
+
+def wav_data_layout(name) -> tuple:
+    """
+    Locates the data chunk of a PCM wav file
+
+    Parameters:
+    -----------
+    name : str
+        The name of the file
+
+    Returns:
+    --------
+    tuple : (sample_rate, n_channels, sample_width, data_offset, data_size)
+    """
+    file_size = os.path.getsize(name)
+
+    with open(name, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError(name + " is not a wav file")
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(name + " has no data chunk")
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(chunk_size - 16 + (chunk_size & 1), 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(name + " has no fmt chunk before the data")
+                data_offset = f.tell()
+                # the size is not filled in when the writer was streaming
+                data_size = min(chunk_size, file_size - data_offset)
+                break
+            else:
+                f.seek(chunk_size + (chunk_size & 1), 1)
+
+    audio_format, n_channels, sample_rate, _, _, bits = fmt
+    # 0xFFFE is WAVE_FORMAT_EXTENSIBLE, used by ffmpeg for some layouts
+    if audio_format not in (1, 0xFFFE) or bits != 16:
+        raise ValueError(name + " is not 16 bit PCM")
+
+    return sample_rate, n_channels, bits // 8, data_offset, data_size
+
+def _to_int16(y) -> np.ndarray:
+    return np.clip(np.round(y), -32768, 32767).astype(np.int16)
 
 class StereoAudioFile:
     """
@@ -15,23 +190,101 @@ class StereoAudioFile:
             Name of the file
         """
         self.name = name
-        
-    def read(self) -> None:
+        self.channels = None
+
+    def read_header(self) -> None:
         """
-        Reads the file and extracts the data
+        Reads only the parameters of the file
         """
-        wav_file = wave.open(self.name, 'rb')
-        
+        with wave.open(self.name, 'rb') as wav_file:
+            self._read_params(wav_file)
+
+    def _read_params(self, wav_file) -> None:
         self.sample_rate = wav_file.getframerate()
         self.n_channels = wav_file.getnchannels()
         self.n_frames = wav_file.getnframes()
         
         self.duration = wav_file.getnframes() / wav_file.getframerate()
         
+    def read(self, memory_map=False) -> None:
+        """
+        Reads the file and extracts the data
+
+        Parameters:
+        -----------
+        memory_map : bool
+            If true, channels is a read-only view over the file mapped in
+            memory and only the parts that are used are read from disk
+        """
+        if memory_map:
+            self._map()
+            return
+
+        wav_file = wave.open(self.name, 'rb')
+        
+        self._read_params(wav_file)
+        
         data = wav_file.readframes(wav_file.getnframes())
         self.channels = np.frombuffer(data, np.int16)
         self.channels.shape = (wav_file.getnframes(), wav_file.getnchannels())
         self.channels = self.channels.T
+
+    def _map(self) -> None:
+        self.sample_rate, self.n_channels, sampwidth, offset, size = wav_data_layout(self.name)
+        self.n_frames = size // (sampwidth * self.n_channels)
+        self.duration = self.n_frames / self.sample_rate
+
+        if self.n_frames == 0:
+            self.channels = np.zeros((self.n_channels, 0), dtype=np.int16)
+            return
+
+        self.channels = np.memmap(self.name, dtype='<i2', mode='r', offset=offset,
+                                  shape=(self.n_frames, self.n_channels)).T
+
+    def read_chunks(self, chunk_frames=65536):
+        """
+        Reads the file chunk by chunk, without keeping the data
+
+        Parameters:
+        -----------
+        chunk_frames : int
+            The number of frames in a chunk
+
+        Yields:
+        -------
+        ndarray : the channel data of the chunk, one channel per row
+        """
+        with wave.open(self.name, 'rb') as wav_file:
+            self._read_params(wav_file)
+
+            while True:
+                data = wav_file.readframes(chunk_frames)
+                if not data:
+                    break
+                yield np.frombuffer(data, np.int16).reshape(-1, self.n_channels).T
+
+    def read_interval(self, start_frame, end_frame) -> np.ndarray:
+        """
+        Reads only the frames of an interval from the file
+
+        Parameters:
+        -----------
+        start_frame : int
+            The first frame
+        end_frame : int
+            The frame after the last one
+
+        Returns:
+        --------
+        ndarray : the channel data, one channel per row
+        """
+        with wave.open(self.name, 'rb') as wav_file:
+            self._read_params(wav_file)
+            start_frame = min(max(start_frame, 0), self.n_frames)
+            wav_file.setpos(start_frame)
+            data = wav_file.readframes(max(end_frame - start_frame, 0))
+
+        return np.frombuffer(data, np.int16).reshape(-1, self.n_channels).T
     
     def write(self, channels, sampwidth, sample_rate) -> None:
         """
@@ -53,21 +306,16 @@ class StereoAudioFile:
         wave_file.writeframes(channels.astype(np.int16).tobytes())
         
     
-    def convert_to_mono(self) -> list:
+    def convert_to_mono(self) -> np.ndarray:
         """
         Converts the stero audio into mono audio
 
         Returns:
         --------
-        mono : list
+        mono : ndarray
             The mono samples
         """
-        mono = []
-        
-        for i in range(0, self.n_frames):
-            mono.append((np.int16)(((int)(self.channels[0][i]) + (int)(self.channels[1][i])) / 2))
-        
-        return mono
+        return downmix(self.channels)
 
 class MonoAudioFile:
     """
@@ -81,6 +329,27 @@ class MonoAudioFile:
             The name of the audio file
         """
         self.name = name
+
+    def load(self, sample_rate, mono_data) -> None:
+        """
+        Loads the samples from memory instead of reading the file
+
+        Parameters:
+        -----------
+        sample_rate: int
+            The sample rate
+        mono_data: ndarray
+            The samples
+        """
+        self.samples = np.asarray(mono_data, dtype=np.int16)
+        self.sample_rate = sample_rate
+        self.n_channels = 1
+        self.n_frames = len(self.samples)
+        self.duration = self.n_frames / sample_rate
+        # byte view over the samples, this is what the VAD consumes
+        self.data = memoryview(self.samples).cast('B')
+        # a single row, so intervals can be taken as from a StereoAudioFile
+        self.channels = self.samples[np.newaxis, :]
         
     def write(self, sample_rate, mono_data) -> None:
         """
@@ -107,6 +376,44 @@ class MonoAudioFile:
         self.n_frames = wav_file.getnframes()
         self.duration = wav_file.getnframes() / wav_file.getframerate()
         self.data = wav_file.readframes(self.n_frames)
+        self.samples = np.frombuffer(self.data, np.int16)
+        self.channels = self.samples[np.newaxis, :]
+
+    def read_chunks(self, chunk_frames=65536):
+        """
+        Reads the mono audio file chunk by chunk, without keeping the data
+
+        Parameters:
+        -----------
+        chunk_frames : int
+            The number of frames in a chunk
+
+        Yields:
+        -------
+        ndarray : the samples of the chunk
+        """
+        with wave.open(self.name) as wav_file:
+            self.sample_rate = wav_file.getframerate()
+            self.n_channels = wav_file.getnchannels()
+            self.n_frames = wav_file.getnframes()
+            self.duration = wav_file.getnframes() / wav_file.getframerate()
+
+            while True:
+                data = wav_file.readframes(chunk_frames)
+                if not data:
+                    break
+                yield np.frombuffer(data, np.int16)
+
+    def resample(self, tsr) -> None:
+        """
+        Resamples the loaded samples in memory
+
+        Parameters:
+        -----------
+        tsr: int
+            The target sample rate
+        """
+        self.load(tsr, resample(self.samples, self.sample_rate, tsr))
         
     def resample_and_save(self, new_name, osr, tsr):
         """
@@ -121,14 +428,196 @@ class MonoAudioFile:
         tsr: int
             The target sample rate
         """
-        x, sr = librosa.load(self.name, sr=osr)
-        y = librosa.resample(x, orig_sr=osr, target_sr=tsr)
-        sf.write(new_name, y, tsr, subtype="PCM_16")
+        self.read()
+        y = resample(self.samples, osr, tsr)
+        wavfile.write(new_name, tsr, y)
+
+class FfmpegAudioStream:
+    """
+    Class used for decoding the audio of a media file through an ffmpeg pipe
+
+    ffmpeg converts the audio to the needed rate and channels and writes raw
+    samples to its output, so nothing is decoded to disk and the samples
+    can be used while the decoding is still running.
+    """
+    def __init__(self, name, sample_rate=16000, n_channels=1, ffmpeg="ffmpeg"):
+        """
+        Parameters:
+        -----------
+        name : str
+            The media file
+        sample_rate : int
+            The sample rate of the output
+        n_channels : int
+            The number of channels of the output
+        ffmpeg : str
+            The ffmpeg executable
+        """
+        self.name = name
+        self.sample_rate = sample_rate
+        self.n_channels = n_channels
+        self.ffmpeg = ffmpeg
+        self.n_frames = 0
+        self.duration = 0
+
+    def read_chunks(self, chunk_frames=65536):
+        """
+        Decodes the file chunk by chunk
+
+        Parameters:
+        -----------
+        chunk_frames : int
+            The number of frames in a chunk
+
+        Yields:
+        -------
+        ndarray : the samples of the chunk, interleaved if there are more
+        channels
+        """
+        command = [self.ffmpeg, "-nostdin", "-loglevel", "error", "-i", self.name,
+                   "-vn", "-ac", str(self.n_channels), "-ar", str(self.sample_rate),
+                   "-f", "s16le", "-acodec", "pcm_s16le", "-"]
+        frame_bytes = 2 * self.n_channels
+        chunk_bytes = chunk_frames * frame_bytes
+
+        self.n_frames = 0
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            carry = b""
+            while True:
+                with METRICS.span("ffmpeg"):
+                    data = process.stdout.read(chunk_bytes)
+                if not data:
+                    break
+
+                # a read can end in the middle of a frame
+                data = carry + data
+                usable = len(data) - len(data) % frame_bytes
+                carry = data[usable:]
+                if usable == 0:
+                    continue
+
+                self.n_frames += usable // frame_bytes
+                self.duration = self.n_frames / self.sample_rate
+                yield np.frombuffer(data[:usable], np.int16)
+
+            if process.wait() != 0:
+                raise RuntimeError("ffmpeg failed on " + self.name + ": "
+                                   + process.stderr.read().decode(errors="replace").strip())
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+class PcmSpool:
+    """
+    Class used for keeping decoded audio on disk while it is still decoded
+
+    The samples are appended to a raw file as they arrive and intervals can
+    be read back at the same time from other threads, in the same way as
+    from a StereoAudioFile in streaming mode.
+    """
+    def __init__(self, name, sample_rate, n_channels=1):
+        """
+        Parameters:
+        -----------
+        name : str
+            The raw file
+        sample_rate : int
+            The sample rate
+        n_channels : int
+            The number of channels
+        """
+        self.name = name
+        self.sample_rate = sample_rate
+        self.n_channels = n_channels
+        self.n_frames = 0
+        self.duration = 0
+        self.channels = None
+        self._file = open(name, 'wb')
+        self._reader = os.open(name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def append(self, samples) -> None:
+        """
+        Appends samples at the end of the file
+
+        Parameters:
+        -----------
+        samples : ndarray
+            The samples, interleaved if there are more channels
+        """
+        samples = np.asarray(samples, dtype=np.int16)
+        self._file.write(samples.tobytes())
+        self._file.flush()
+        self.n_frames += len(samples) // self.n_channels
+        self.duration = self.n_frames / self.sample_rate
+
+    def tee(self, chunks):
+        """
+        Appends every chunk of a stream while passing it on
+
+        Parameters:
+        -----------
+        chunks : iterable
+            The sample chunks
+
+        Yields:
+        -------
+        ndarray : the same chunks
+        """
+        for chunk in chunks:
+            self.append(chunk)
+            yield chunk
+
+    def read_interval(self, start_frame, end_frame) -> np.ndarray:
+        """
+        Reads the frames of an interval that was already appended
+
+        Parameters:
+        -----------
+        start_frame : int
+            The first frame
+        end_frame : int
+            The frame after the last one
+
+        Returns:
+        --------
+        ndarray : the channel data, one channel per row
+        """
+        start_frame = min(max(start_frame, 0), self.n_frames)
+        end_frame = min(max(end_frame, start_frame), self.n_frames)
+        frame_bytes = 2 * self.n_channels
+
+        data = _pread(self._reader, (end_frame - start_frame) * frame_bytes, start_frame * frame_bytes)
+
+        return np.frombuffer(data, np.int16).reshape(-1, self.n_channels).T
+
+    def close(self) -> None:
+        """
+        Closes the file, it is kept on disk
+        """
+        self._file.close()
+        os.close(self._reader)
+
+def _pread(fd, size, offset) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+
+    # there is no pread on Windows, a lock keeps seek and read together
+    with _pread_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+_pread_lock = threading.Lock()
 
 class Segment:
     """
     Class used for modeling an audio segment
     """
+    __slots__ = ("data", "timestamp", "duration")
+
     def __init__(self, data, timestamp, duration):
         """
         Parameters:
@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import engine
+from artifacts import ArtifactStore
+from cache import TranscriptionCache
+from client import is_transient
+from metrics import METRICS
+from recognizer import BACKENDS, ENCODINGS
+from subhelper import SubtitleWriter, FORMATS
+
+MEDIA_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm", ".wav", ".mp3", ".flac", ".ogg", ".m4a")
+
+def find_media(paths, extensions=MEDIA_EXTENSIONS) -> list:
+    """
+    Lists the media files to process
+
+    Parameters:
+    -----------
+    paths : list
+        Media files and directories, the directories are searched
+        recursively for files with one of the extensions
+    extensions : tuple
+        The extensions of the media files, in lower case
+
+    Returns:
+    --------
+    list : the absolute file names, without duplicates
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(extensions):
+                        files.append(os.path.join(root, name))
+        else:
+            files.append(path)
+
+    return list(dict.fromkeys(os.path.abspath(name) for name in files))
+
+def job_id(media_file) -> str:
+    """
+    Names the working directory of a media file
+
+    The name is stable across runs, which is what makes a batch resumable,
+    and files with the same name in different directories do not collide.
+
+    Parameters:
+    -----------
+    media_file : str
+        The absolute name of the media file
+
+    Returns:
+    --------
+    str : the name of the job
+    """
+    stem = os.path.splitext(os.path.basename(media_file))[0]
+    digest = hashlib.sha1(media_file.encode("utf-8")).hexdigest()[:8]
+    return stem + "-" + digest
+
+def run_job(job) -> dict:
+    """
+    Generates the subtitles of one media file, in its own working directory
+
+    Runs in a worker process. A job that already finished for the same
+    input is skipped, unless some of its intervals failed for a transient
+    reason, like throttling or timeouts, then its status is "partial" and
+    it runs again on the next batch. The subtitles are written to a .part file as they are
+    recognized, which is renamed when the job succeeds, so an interrupted
+    job is started again on the next run, and with a cache the intervals it
+    already recognized are not sent again.
+
+    Parameters:
+    -----------
+    job : dict
+        The media file, the output directory and the options of the batch
+
+    Returns:
+    --------
+    dict : the summary of the job
+    """
+    media_file = job["media_file"]
+    work_dir = os.path.join(job["output_dir"], job_id(media_file))
+    srt_file = os.path.join(work_dir, os.path.splitext(os.path.basename(media_file))[0] + "." + job["format"])
+    summary_file = os.path.join(work_dir, "summary.json")
+    stat = os.stat(media_file)
+
+    summary = {"file": media_file, "srt": srt_file, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    if not job["force"] and os.path.exists(srt_file) and os.path.exists(summary_file):
+        with open(summary_file) as f:
+            previous = json.load(f)
+        if (previous.get("status") == "done" and previous.get("size") == stat.st_size
+                and previous.get("mtime") == stat.st_mtime):
+            previous["status"] = "skipped"
+            return previous
+
+    os.makedirs(work_dir, exist_ok=True)
+    pcm_file = os.path.join(work_dir, "speech.pcm")
+
+    recognizer = BACKENDS[job["backend"]](**job["backend_options"])
+    cache = TranscriptionCache(job["cache"]) if job["cache"] else None
+    store = ArtifactStore(job["store"]) if job["store"] else None
+
+    METRICS.enabled = job["metrics"]
+    METRICS.reset()
+
+    temp_file = srt_file + ".part"
+    subs = []
+    start = time.perf_counter()
+    try:
+        with SubtitleWriter(temp_file, job["format"]) as writer:
+            if store is None:
+                subtitles = engine.media_subtitle_stream(media_file, work_dir, job["ffmpeg"],
+                                                         job["detector"], recognizer,
+                                                         job["recognition_workers"], cache)
+            else:
+                subtitles = engine.stored_subtitle_stream(media_file, store, job["ffmpeg"],
+                                                          job["detector"], recognizer=recognizer,
+                                                          max_workers=job["recognition_workers"],
+                                                          cache=cache, planner=job["planner"])
+            for subtitle in subtitles:
+                writer.write(subtitle)
+                subs.append(subtitle)
+    except Exception as error:
+        summary.update({"status": "failed", "error": repr(error),
+                        "seconds": round(time.perf_counter() - start, 3)})
+        _dump_metrics(work_dir)
+        return summary
+    elapsed = time.perf_counter() - start
+
+    # the 16 kHz mono samples tell the length of the media
+    if store is not None:
+        media_seconds = store.audio_seconds(media_file)
+    else:
+        media_seconds = os.path.getsize(pcm_file) / 2 / 16000
+        if not job["keep_work"]:
+            os.remove(pcm_file)
+
+    os.replace(temp_file, srt_file)
+
+    # the intervals that failed for a transient reason are worth sending again
+    retry = any(len(entry) > 2 and is_transient(entry[2]) for entry in subs)
+    summary.update({"status": "partial" if retry else "done", "media_seconds": round(media_seconds, 3),
+                    "seconds": round(elapsed, 3),
+                    "realtime_factor": round(media_seconds / elapsed, 2) if elapsed > 0 else None,
+                    "intervals": len(subs),
+                    "subtitles": sum(1 for entry in subs if entry[1] != ""),
+                    "failed_intervals": sum(1 for entry in subs if entry[1] == "")})
+    reasons = {}
+    for entry in subs:
+        if len(entry) > 2:
+            reasons[entry[2]] = reasons.get(entry[2], 0) + 1
+    if reasons:
+        summary["failure_reasons"] = reasons
+    if cache is not None:
+        summary["cache_hits"] = cache.hits
+
+    _dump_metrics(work_dir)
+
+    with open(summary_file + ".part", "w") as f:
+        json.dump(summary, f)
+    os.replace(summary_file + ".part", summary_file)
+
+    return summary
+
+def _dump_metrics(work_dir):
+    if METRICS.enabled:
+        METRICS.dump(os.path.join(work_dir, "metrics.json"))
+        METRICS.dump(os.path.join(work_dir, "metrics.prom"))
+
+def run_batch(media_files, output_dir, jobs=None, **options):
+    """
+    Generates the subtitles of many media files on a process pool
+
+    Parameters:
+    -----------
+    media_files : list
+        The absolute names of the media files
+    output_dir : str
+        Every media file gets its own directory in it
+    jobs : int
+        The number of processes, one per core by default
+    options :
+        The options of run_job
+
+    Yields:
+    -------
+    the summary of every job, as the jobs finish
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_job, dict(options, media_file=media_file,
+                                                 output_dir=output_dir)): media_file
+                   for media_file in media_files}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as error:
+                # the worker process itself died
+                yield {"file": futures[future], "status": "failed", "error": repr(error)}
+
+def total_summary(summaries, seconds) -> dict:
+    """
+    Sums up the throughput of a batch
+
+    Parameters:
+    -----------
+    summaries : list
+        The summaries of the jobs
+    seconds : float
+        The wall time of the batch
+
+    Returns:
+    --------
+    dict : the totals
+    """
+    done = [summary for summary in summaries if summary["status"] in ("done", "partial")]
+    media_seconds = sum(summary["media_seconds"] for summary in done)
+
+    return {"files": len(summaries),
+            "done": sum(1 for summary in summaries if summary["status"] == "done"),
+            "partial": sum(1 for summary in summaries if summary["status"] == "partial"),
+            "skipped": sum(1 for summary in summaries if summary["status"] == "skipped"),
+            "failed": sum(1 for summary in summaries if summary["status"] == "failed"),
+            "media_seconds": round(media_seconds, 3), "seconds": round(seconds, 3),
+            "realtime_factor": round(media_seconds / seconds, 2) if seconds > 0 else None}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates the subtitles of many media files")
+    parser.add_argument("inputs", nargs="*", help="media files and directories")
+    parser.add_argument("--list", help="a file with one media file or directory per line")
+    parser.add_argument("-o", "--output", default="output", help="the output directory")
+    parser.add_argument("-j", "--jobs", type=int, help="the number of processes, one per core by default")
+    parser.add_argument("--workers", type=int, default=4, help="recognizer requests in flight per job")
+    parser.add_argument("--detector", default="webrtc", choices=engine.DETECTORS)
+    parser.add_argument("--backend", default="google", choices=sorted(BACKENDS))
+    parser.add_argument("--url", help="the address of the http backend")
+    parser.add_argument("--encoding", default="flac", choices=sorted(ENCODINGS),
+                        help="the encoding of the audio posted to the http backend")
+    parser.add_argument("--language", default="en-US")
+    parser.add_argument("--cache", help="the transcription cache, shared by all the jobs")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--format", default="srt", choices=FORMATS)
+    parser.add_argument("--ffmpeg", default="ffmpeg")
+    parser.add_argument("--force", action="store_true", help="process the files that are already done")
+    parser.add_argument("--keep-work", action="store_true", help="keep the 16 kHz audio of every job")
+    parser.add_argument("--store", help="keep the output of every stage in this artifact store, "
+                                        "so a run with other parameters only recomputes what changed")
+    parser.add_argument("--planner", action="store_true",
+                        help="plan fewer and shorter recognizer requests from the speech mask, needs --store")
+    parser.add_argument("--metrics", action="store_true",
+                        help="write the stage timings and counters of every job, as json and Prometheus text")
+    args = parser.parse_args()
+
+    paths = list(args.inputs)
+    if args.list:
+        with open(args.list) as f:
+            paths += [line.strip() for line in f if line.strip()]
+    media_files = find_media(paths)
+    if not media_files:
+        parser.error("no media files given")
+
+    if args.planner and not args.store:
+        parser.error("--planner needs --store")
+
+    backend_options = {"language": args.language}
+    if args.backend == "http":
+        if not args.url:
+            parser.error("the http backend needs --url")
+        backend_options["url"] = args.url
+        backend_options["encoding"] = args.encoding
+
+    cache = None
+    if not args.no_cache:
+        cache = os.path.abspath(args.cache or os.path.join(args.output, "transcriptions.sqlite"))
+
+    start = time.perf_counter()
+    summaries = []
+    for summary in run_batch(media_files, os.path.abspath(args.output), args.jobs,
+                             format=args.format, ffmpeg=args.ffmpeg, detector=args.detector, backend=args.backend,
+                             backend_options=backend_options, recognition_workers=args.workers,
+                             cache=cache, force=args.force, keep_work=args.keep_work,
+                             metrics=args.metrics, planner=args.planner,
+                             store=os.path.abspath(args.store) if args.store else None):
+        summaries.append(summary)
+        print(json.dumps(summary), flush=True)
+
+    total = total_summary(summaries, time.perf_counter() - start)
+    print(json.dumps(total))
+    with open(os.path.join(args.output, "summary.json"), "w") as f:
+        json.dump({"total": total, "files": summaries}, f, indent=2)
@@ -0,0 +1,600 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+import engine
+from client import ResilientBackend
+from metrics import METRICS
+from audio import StereoAudioFile, MonoAudioFile, resample
+from recognizer import RecognizerBackend, HttpBackend
+from renderer import SubtitleRenderer
+from standin_server import StandInServer
+from subhelper import SubtitleIndex
+from videostream import VideoStream
+
+class StubBackend(RecognizerBackend):
+    """
+    A recognizer that answers at once, for measuring without the network
+    """
+    name = "stub"
+
+    def recognize(self, audio) -> str:
+        return "speech of %d bytes" % len(audio.frame_data)
+
+def synthetic_wav(file_name, seconds, sample_rate=44100, seed=0, kind="speech") -> None:
+    """
+    Writes a stereo wav file with bursts of speech-like noise and silence,
+    or only silence
+
+    Parameters:
+    -----------
+    file_name : str
+        The file to write
+    seconds : float
+        The length of the audio
+    sample_rate : int
+        The sample rate
+    seed : int
+        The seed of the noise
+    kind : str
+        "speech" or "silence"
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sample_rate)
+    t = np.arange(n) / sample_rate
+
+    # a voiced tone with noise, switched on and off every couple of seconds
+    voice = np.sin(2 * np.pi * 180 * t) + 0.5 * np.sin(2 * np.pi * 360 * t)
+    voice += 0.3 * rng.standard_normal(n)
+    gate = np.sin(2 * np.pi * 0.2 * t) > 0
+    mono = (voice * gate * 6000).astype(np.int16)
+    if kind == "silence":
+        mono[:] = 0
+
+    StereoAudioFile(file_name).write(np.stack((mono, mono)).T, 2, sample_rate)
+
+def synthetic_video(file_name, seconds, width=640, height=360, fps=25) -> None:
+    """
+    Writes a video of a gradient with a moving bar
+
+    Parameters:
+    -----------
+    file_name : str
+        The file to write, an .avi file
+    seconds : float
+        The length of the video
+    width : int
+        The width of the frames
+    height : int
+        The height of the frames
+    fps : float
+        The frame rate
+    """
+    writer = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:, :, 2] = np.linspace(0, 255, width, dtype=np.uint8)
+    for i in range((int) (seconds * fps)):
+        x = (i * 4) % width
+        frame[:, :, 1] = 0
+        frame[:, x:x + 16, 1] = 255
+        writer.write(frame)
+    writer.release()
+
+def measure(function, media_seconds, repeat=3) -> dict:
+    """
+    Times a stage and measures the peak of the memory it allocates
+
+    The time is the best of repeat runs. The memory is traced in one more
+    run, because tracing slows the stage down.
+
+    Parameters:
+    -----------
+    function : callable
+        Runs the stage
+    media_seconds : float
+        The length of the media the stage goes through
+    repeat : int
+        The number of timed runs
+
+    Returns:
+    --------
+    dict : the seconds, the media seconds per wall second and the peak
+    memory in MB
+    """
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"seconds": round(seconds, 6),
+            "throughput": round(media_seconds / seconds, 1) if seconds > 0 else None,
+            "peak_mb": round(peak / 2 ** 20, 2)}
+
+def audio_stages(work_dir, kind, seconds, workers=4) -> dict:
+    """
+    Builds the audio stages, in isolation and end to end, on a synthetic
+    input
+
+    Parameters:
+    -----------
+    work_dir : str
+        The directory of the input files
+    kind : str
+        "speech" or "silence"
+    seconds : float
+        The length of the input
+    workers : int
+        The number of recognizer requests in flight
+
+    Returns:
+    --------
+    dict : the stages by name, as functions without arguments
+    """
+    file_name = os.path.join(work_dir, kind + ".wav")
+    mono_name = os.path.join(work_dir, kind + "_mono.wav")
+    synthetic_wav(file_name, seconds, kind=kind)
+
+    stereo = StereoAudioFile(file_name)
+    stereo.read()
+    mono = stereo.convert_to_mono()
+    MonoAudioFile(mono_name).write(stereo.sample_rate, mono)
+    data = engine.prepare_speech_audio(stereo).data
+    timestamps = engine.detect_audio_segment(data, 16000)
+    intervals = engine.generate_intervals(timestamps)
+    recognizer = StubBackend()
+
+    def is_speech():
+        for segment in engine.segment_generator(10, data, 16000):
+            engine.is_speech(segment.data, 16000)
+
+    return {
+        "convert_to_mono": stereo.convert_to_mono,
+        "resample": lambda: resample(mono, stereo.sample_rate, 16000),
+        "resample_and_save": lambda: MonoAudioFile(mono_name).resample_and_save(
+            os.path.join(work_dir, kind + "_16k.wav"), stereo.sample_rate, 16000),
+        "segment_generator": lambda: sum(1 for _ in engine.segment_generator(10, data, 16000)),
+        "is_speech": is_speech,
+        "detect_webrtc": lambda: engine.detect_audio_segment(data, 16000, detector="webrtc"),
+        "detect_spectral": lambda: engine.detect_audio_segment(data, 16000, detector="spectral"),
+        "generate_intervals": lambda: engine.generate_intervals(timestamps),
+        "recognize_intervals": lambda: list(engine.recognize_intervals(stereo, intervals, recognizer,
+                                                                       workers)),
+        "end_to_end": lambda: engine.generate_subtitles(file_name, recognizer=recognizer,
+                                                        max_workers=workers),
+        "end_to_end_streaming": lambda: engine.generate_subtitles(file_name, streaming=True,
+                                                                  recognizer=recognizer,
+                                                                  max_workers=workers),
+    }
+
+def video_stages(work_dir, seconds, width=640, height=360, fps=25) -> dict:
+    """
+    Builds the video stages of the player on a synthetic video, the
+    decoding and the subtitle drawing of App.update without the display
+
+    Parameters:
+    -----------
+    work_dir : str
+        The directory of the video file
+    seconds : float
+        The length of the video
+    width : int
+        The width of the frames
+    height : int
+        The height of the frames
+    fps : float
+        The frame rate
+
+    Returns:
+    --------
+    dict : the stages by name, as functions without arguments
+    """
+    file_name = os.path.join(work_dir, "video.avi")
+    synthetic_video(file_name, seconds, width, height, fps)
+
+    video = VideoStream(file_name)
+    frames = []
+    while True:
+        ret, frame = video.get_frame()
+        if not ret:
+            break
+        frames.append(frame)
+    video.stop()
+
+    # a two second subtitle every four seconds, some long enough to wrap
+    subs = SubtitleIndex([[[t, t + 2.0], ("subtitle %d " % t) * (1 + t % 5)]
+                          for t in range(0, (int) (seconds), 4)])
+    renderer = SubtitleRenderer()
+
+    def decode():
+        stream = VideoStream(file_name)
+        while stream.get_frame()[0]:
+            pass
+        stream.stop()
+
+    def render():
+        for i, frame in enumerate(frames):
+            string = subs.find(i / fps)
+            if string != "":
+                frame = frame.copy()
+                renderer.render(frame, string, width // 2, (int) (height * 0.9), 1.0, (255, 255, 0), 1)
+
+    return {"video_decode": decode, "subtitle_render": render}
+
+def compare(results, baseline, tolerance=0.2) -> None:
+    """
+    Flags the stages that got slower or use more memory than the baseline
+
+    Parameters:
+    -----------
+    results : list
+        The results of bench_stages, changed in place
+    baseline : list
+        Earlier results of bench_stages
+    tolerance : float
+        The relative change allowed before a stage is flagged
+    """
+    previous = {(result["input"], result["stage"]): result for result in baseline}
+    for result in results:
+        reference = previous.get((result["input"], result["stage"]))
+        if reference is None:
+            continue
+
+        result["baseline_throughput"] = reference["throughput"]
+        result["baseline_peak_mb"] = reference["peak_mb"]
+        slower = result["throughput"] < reference["throughput"] * (1 - tolerance)
+        # small allocations are noise
+        bigger = result["peak_mb"] > max(reference["peak_mb"] * (1 + tolerance), reference["peak_mb"] + 1)
+        result["regression"] = bool(slower or bigger)
+
+def bench_stages(args) -> list:
+    """
+    Measures every stage in isolation and end to end on synthetic inputs,
+    offline with a stub recognizer, and compares with a stored baseline
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for kind in args.inputs:
+            stages = audio_stages(work_dir, kind, args.minutes * 60, args.workers)
+            for name, function in stages.items():
+                if args.stage and name not in args.stage:
+                    continue
+                result = {"input": kind, "stage": name}
+                result.update(measure(function, args.minutes * 60, args.repeat))
+                results.append(result)
+
+        if args.video_seconds > 0:
+            stages = video_stages(work_dir, args.video_seconds)
+            for name, function in stages.items():
+                if args.stage and name not in args.stage:
+                    continue
+                result = {"input": "video", "stage": name}
+                result.update(measure(function, args.video_seconds, args.repeat))
+                results.append(result)
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            compare(results, json.load(f), args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+def bench_resilience(args) -> list:
+    """
+    Measures the failed intervals and the requests made with and without
+    the resilient client, against a stand-in server that injects failures
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_name = os.path.join(work_dir, "audio.wav")
+        synthetic_wav(file_name, args.intervals * 2)
+        stereo = StereoAudioFile(file_name)
+        stereo.read()
+    intervals = [[2.0 * i, 2.0 * i + 1.5] for i in range(args.intervals)]
+
+    for client in args.clients:
+        with StandInServer(args.latency, jitter=args.latency, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, timeout_rate=args.timeout_rate,
+                           hang=args.timeout * 1.5, capacity=args.capacity, seed=args.seed) as server:
+            backend = HttpBackend(server.url, timeout=args.timeout)
+            if client == "resilient":
+                backend = ResilientBackend(backend, rate=args.rate, initial_concurrency=args.workers,
+                                           max_concurrency=args.workers, backoff=0.1,
+                                           max_backoff=2.0, seed=args.seed)
+
+            start = time.perf_counter()
+            output = list(engine.recognize_intervals(stereo, intervals, backend, args.workers))
+            elapsed = time.perf_counter() - start
+
+            reasons = {}
+            for entry in output:
+                if len(entry) > 2:
+                    reasons[entry[2]] = reasons.get(entry[2], 0) + 1
+            results.append({"client": client, "intervals": len(output),
+                            "failed": sum(reasons.values()), "reasons": reasons,
+                            "requests": server.requests, "max_in_flight": server.max_in_flight,
+                            "answers": {str(status): count for status, count in server.answered.items()},
+                            "seconds": round(elapsed, 3)})
+    return results
+
+def bench_payload(args) -> list:
+    """
+    Measures the size and the upload time of the recognizer requests for
+    every encoding, against the stand-in server behind a slow uplink
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_name = args.file
+        if file_name is None:
+            file_name = os.path.join(work_dir, "audio.wav")
+            synthetic_wav(file_name, args.intervals * 2)
+        stereo = StereoAudioFile(file_name)
+        stereo.read()
+        mono = engine.prepare_speech_audio(stereo, engine.RECOGNIZER_SAMPLE_RATE)
+    intervals = [[2.0 * i, 2.0 * i + 1.5] for i in range(args.intervals)]
+
+    enabled = METRICS.enabled
+    METRICS.enabled = True
+    results = []
+    try:
+        for encoding, sample_rate in (("wav", None), ("wav", engine.RECOGNIZER_SAMPLE_RATE),
+                                      ("flac", engine.RECOGNIZER_SAMPLE_RATE)):
+            # the source rate is sent from the source, the lower rate from the speech detection audio
+            audio_object = stereo if sample_rate is None else mono
+            METRICS.reset()
+            with StandInServer(args.latency, bandwidth=args.bandwidth) as server:
+                backend = HttpBackend(server.url, encoding=encoding)
+                start = time.perf_counter()
+                output = list(engine.recognize_intervals(audio_object, intervals, backend, args.workers,
+                                                         sample_rate))
+                elapsed = time.perf_counter() - start
+
+            encode = METRICS.histograms[("stage_seconds", (("stage", "payload_encode"),))]
+            upload = METRICS.histograms[("recognizer_upload_seconds", ())]
+            results.append({"encoding": encoding, "sample_rate": sample_rate or stereo.sample_rate,
+                            "requests": server.requests,
+                            "failed": sum(1 for entry in output if entry[1] == ""),
+                            "bytes_per_request": round(server.received_bytes / server.requests),
+                            "encode_ms_per_request": round(1000 * encode.sum / encode.count, 3),
+                            "upload_ms_per_request": round(1000 * upload.sum / upload.count, 3),
+                            "seconds": round(elapsed, 3)})
+    finally:
+        METRICS.enabled = enabled
+        METRICS.reset()
+    return results
+
+def bench_planner(args) -> list:
+    """
+    Compares the recognizer requests and the uploaded audio of the interval
+    planner with those of generate_intervals
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_name = args.file
+        if file_name is None:
+            file_name = os.path.join(work_dir, "audio.wav")
+            synthetic_wav(file_name, args.minutes * 60)
+        stereo = StereoAudioFile(file_name)
+        stereo.read()
+        mono = engine.prepare_speech_audio(stereo)
+
+    mask = engine.speech_frame_mask(mono.data, mono.sample_rate, detector=args.detector)
+    results = []
+    for max_duration in args.max_duration:
+        report = engine.plan_speech_intervals(mask, mono, max_duration=max_duration)[1]
+        results.append(dict({"max_duration": max_duration}, **report))
+    return results
+
+def bench_recognition(args) -> list:
+    """
+    Measures the recognition throughput against the number of requests in
+    flight, using the local stand-in server
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_name = os.path.join(work_dir, "audio.wav")
+        synthetic_wav(file_name, args.intervals * 2)
+        stereo = StereoAudioFile(file_name)
+        stereo.read()
+        intervals = [[2.0 * i, 2.0 * i + 1.5] for i in range(args.intervals)]
+
+        with StandInServer(args.latency) as server:
+            backend = HttpBackend(server.url)
+            for workers in args.workers:
+                start = time.perf_counter()
+                output = list(engine.recognize_intervals(stereo, intervals, backend, workers))
+                elapsed = time.perf_counter() - start
+
+                failed = sum(1 for entry in output if entry[1] == "")
+                results.append({"workers": workers, "intervals": len(output), "failed": failed,
+                                "seconds": round(elapsed, 3),
+                                "requests_per_second": round(len(output) / elapsed, 2)})
+    return results
+
+def bench_vad(args) -> list:
+    """
+    Measures the sharded speech detection against the number of processes
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_name = os.path.join(work_dir, "audio.wav")
+        synthetic_wav(file_name, args.minutes * 60)
+        stereo = StereoAudioFile(file_name)
+        stereo.read()
+        data = engine.prepare_speech_audio(stereo).data
+
+    start = time.perf_counter()
+    single_timestamps = engine.detect_audio_segment(data, 16000, detector=args.detector)
+    single = time.perf_counter() - start
+    results = [{"mode": "single", "seconds": round(single, 3)}]
+
+    reference = None
+    base = None
+    for workers in args.workers or _core_counts():
+        start = time.perf_counter()
+        timestamps = engine.detect_audio_segment_sharded(data, 16000, detector=args.detector,
+                                                         shard_duration=args.shard,
+                                                         max_workers=workers)
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference = timestamps
+            base = elapsed
+        results.append({"mode": "sharded", "workers": workers, "seconds": round(elapsed, 3),
+                        "speedup": round(base / elapsed, 2),
+                        "identical_across_workers": timestamps == reference,
+                        "matches_single": timestamps == single_timestamps})
+    return results
+
+def bench_display(args) -> list:
+    """
+    Measures the per-frame cost and the memory of showing frames on a Tk
+    canvas, with a new image item per frame against one reused item
+    """
+    import tkinter
+    import PIL.Image, PIL.ImageTk
+    from display import FrameDisplay
+
+    n_frames = int(args.minutes * 60 * args.fps)
+    every = max(1, n_frames // args.samples)
+    frame = np.zeros((args.height, args.width, 3), dtype=np.uint8)
+    frame[:, :, 0] = np.linspace(0, 255, args.width, dtype=np.uint8)
+
+    root = tkinter.Tk()
+    results = []
+    for mode in args.modes:
+        canvas = tkinter.Canvas(root, width = args.width, height = args.height)
+        canvas.pack()
+        display = FrameDisplay(canvas, args.width, args.height) if mode == "paste" else None
+
+        start = time.perf_counter()
+        for i in range(1, n_frames + 1):
+            frame[:, :, 1] = i % 256
+            if display is not None:
+                display.show(frame)
+            else:
+                photo = PIL.ImageTk.PhotoImage(image = PIL.Image.fromarray(frame))
+                canvas.create_image(0, 0, image = photo, anchor = tkinter.NW)
+            root.update_idletasks()
+
+            if i % every == 0:
+                elapsed = time.perf_counter() - start
+                results.append({"mode": mode, "playback_minutes": round(i / args.fps / 60, 1),
+                                "ms_per_frame": round(elapsed * 1000 / every, 3),
+                                "rss_mb": round(_rss_mb(), 1),
+                                "canvas_items": len(canvas.find_all())})
+                start = time.perf_counter()
+
+        canvas.destroy()
+    root.destroy()
+    return results
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        # no procfs, the peak is the best there is
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _core_counts() -> list:
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+BENCHMARKS = {
+    "recognition": bench_recognition,
+    "vad": bench_vad,
+    "display": bench_display,
+    "stages": bench_stages,
+    "planner": bench_planner,
+    "resilience": bench_resilience,
+    "payload": bench_payload,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Subtitle generator benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    recognition = subparsers.add_parser("recognition", help="recognizer throughput against concurrency")
+    recognition.add_argument("--intervals", type=int, default=64)
+    recognition.add_argument("--latency", type=float, default=0.2)
+    recognition.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+
+    vad = subparsers.add_parser("vad", help="sharded speech detection against the number of cores")
+    vad.add_argument("--minutes", type=float, default=10)
+    vad.add_argument("--detector", default="webrtc", choices=engine.DETECTORS)
+    vad.add_argument("--shard", type=float, default=60.0, help="shard length in seconds")
+    vad.add_argument("--workers", type=int, nargs="+", help="the core counts, powers of two by default")
+
+    display = subparsers.add_parser("display", help="canvas display cost and memory over a long playback")
+    display.add_argument("--minutes", type=float, default=120)
+    display.add_argument("--fps", type=float, default=25)
+    display.add_argument("--width", type=int, default=640)
+    display.add_argument("--height", type=int, default=360)
+    display.add_argument("--samples", type=int, default=12, help="the number of measurements")
+    display.add_argument("--modes", nargs="+", default=["paste", "create_image"],
+                         choices=["paste", "create_image"])
+
+    stages = subparsers.add_parser("stages", help="every stage in isolation and end to end, offline")
+    stages.add_argument("--minutes", type=float, default=5, help="the length of the audio inputs")
+    stages.add_argument("--video-seconds", type=float, default=20, help="the length of the video, 0 to skip it")
+    stages.add_argument("--inputs", nargs="+", default=["speech", "silence"], choices=["speech", "silence"])
+    stages.add_argument("--stage", nargs="+", help="only these stages")
+    stages.add_argument("--repeat", type=int, default=3)
+    stages.add_argument("--workers", type=int, default=4, help="recognizer requests in flight")
+    stages.add_argument("--baseline", help="the results to compare with")
+    stages.add_argument("--save-baseline", help="where to store the results as the new baseline")
+    stages.add_argument("--tolerance", type=float, default=0.2)
+
+    planner = subparsers.add_parser("planner", help="requests and audio seconds of the interval planner")
+    planner.add_argument("--file", help="a wav file, synthetic audio by default")
+    planner.add_argument("--minutes", type=float, default=10, help="the length of the synthetic audio")
+    planner.add_argument("--detector", default="webrtc", choices=engine.DETECTORS)
+    planner.add_argument("--max-duration", type=float, nargs="+", default=[4.0, 8.0, 15.0])
+
+    resilience = subparsers.add_parser("resilience", help="recognizer failures against injected errors")
+    resilience.add_argument("--intervals", type=int, default=200)
+    resilience.add_argument("--latency", type=float, default=0.05)
+    resilience.add_argument("--workers", type=int, default=16)
+    resilience.add_argument("--error-rate", type=float, default=0.05)
+    resilience.add_argument("--throttle-rate", type=float, default=0.05)
+    resilience.add_argument("--timeout-rate", type=float, default=0.02)
+    resilience.add_argument("--timeout", type=float, default=1.0, help="the client timeout in seconds")
+    resilience.add_argument("--capacity", type=int, default=8, help="the requests in flight the server takes")
+    resilience.add_argument("--rate", type=float, help="the most requests per second of the resilient client")
+    resilience.add_argument("--seed", type=int, default=0)
+    resilience.add_argument("--clients", nargs="+", default=["plain", "resilient"],
+                            choices=["plain", "resilient"])
+
+    payload = subparsers.add_parser("payload", help="recognizer request size and upload time by encoding")
+    payload.add_argument("--file", help="a wav file, synthetic audio by default")
+    payload.add_argument("--intervals", type=int, default=64)
+    payload.add_argument("--latency", type=float, default=0.05)
+    payload.add_argument("--workers", type=int, default=4)
+    payload.add_argument("--bandwidth", type=float, default=500000,
+                         help="the uplink in bytes per second, added to the server latency")
+
+    args = parser.parse_args()
+    results = BENCHMARKS[args.benchmark](args)
+    for result in results:
+        print(json.dumps(result))
+
+    if any(result.get("regression") for result in results):
+        sys.exit(1)
@@ -0,0 +1,189 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from recognizer import RecognizerBackend
+
+class TranscriptionCache:
+    """
+    Persistent cache of the recognized text, keyed by the exact audio sent
+    to the recognizer and by the recognizer used
+
+    The entries are kept in a sqlite database, which makes the cache safe
+    to share between threads and processes. When the total size goes over
+    max_bytes the least recently used entries are evicted, down to
+    evict_ratio of max_bytes so that evictions stay rare. The number and
+    the total size of the entries are kept in the meta table, so adding
+    an entry does not read the whole table.
+    """
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, evict_ratio=0.9):
+        """
+        Parameters:
+        -----------
+        path : str
+            The database file
+        max_bytes : int
+            The maximum total size of the entries
+        evict_ratio : float
+            The part of max_bytes left after an eviction
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_ratio = evict_ratio
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+                               "key TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                               "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            connection.execute("CREATE TABLE IF NOT EXISTS meta ("
+                               "name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # the totals of a cache made before the meta table are counted once
+            connection.execute("INSERT OR IGNORE INTO meta SELECT 'entries', COUNT(*) FROM entries")
+            connection.execute("INSERT OR IGNORE INTO meta SELECT 'bytes', COALESCE(SUM(size), 0) FROM entries")
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def key(audio, backend) -> str:
+        """
+        Builds the key of an interval
+
+        Parameters:
+        -----------
+        audio : AudioData
+            The audio sent to the recognizer
+        backend : RecognizerBackend
+            The recognizer
+
+        Returns:
+        --------
+        str : the key
+        """
+        h = hashlib.sha256()
+        h.update(audio.frame_data)
+        h.update(("%d:%d:%s:%s" % (audio.sample_rate, audio.sample_width,
+                                   backend.name, backend.language)).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Looks up an entry
+
+        Parameters:
+        -----------
+        key : str
+            The key of the entry
+
+        Returns:
+        --------
+        str : the text, or None if it is not cached
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT text FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE entries SET last_used = ? WHERE key = ?",
+                                   (time.time(), key))
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return None if row is None else row[0]
+
+    def put(self, key, text) -> None:
+        """
+        Adds an entry and evicts the least recently used ones if needed
+
+        Parameters:
+        -----------
+        key : str
+            The key of the entry
+        text : str
+            The recognized text
+        """
+        size = len(key) + len(text.encode())
+
+        connection = self._connect()
+        with connection:
+            # the totals are read and written in one transaction with the entry
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                               (key, text, size, time.time()))
+            entries, total = self._add(connection, 0 if row else 1, size - (row[0] if row else 0))
+
+            target = self.max_bytes * self.evict_ratio
+            while total > self.max_bytes and entries > 0:
+                # as many of the oldest entries as needed on average, the loop takes more if not enough
+                count = -(-(int) (total - target) * entries // total)
+                evicted, evicted_size = connection.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "
+                    "(SELECT size FROM entries ORDER BY last_used LIMIT ?)", (count,)).fetchone()
+                connection.execute("DELETE FROM entries WHERE key IN "
+                                   "(SELECT key FROM entries ORDER BY last_used LIMIT ?)", (count,))
+                entries, total = self._add(connection, -evicted, -evicted_size)
+
+    @staticmethod
+    def _add(connection, entries, size) -> tuple:
+        connection.execute("UPDATE meta SET value = value + ? WHERE name = 'entries'", (entries,))
+        connection.execute("UPDATE meta SET value = value + ? WHERE name = 'bytes'", (size,))
+        meta = dict(connection.execute("SELECT name, value FROM meta").fetchall())
+        return meta["entries"], meta["bytes"]
+
+    def stats(self) -> dict:
+        """
+        Returns:
+        --------
+        dict : the hit and miss counters of this process and the size of the cache
+        """
+        with self._connect() as connection:
+            meta = dict(connection.execute("SELECT name, value FROM meta").fetchall())
+        entries, size = meta["entries"], meta["bytes"]
+
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+class CachedBackend(RecognizerBackend):
+    """
+    A recognizer that only calls the wrapped one for audio that is not cached
+    """
+    def __init__(self, backend, cache):
+        """
+        Parameters:
+        -----------
+        backend : RecognizerBackend
+            The recognizer to call on a miss
+        cache : TranscriptionCache
+            The cache
+        """
+        super().__init__(backend.language)
+        self.name = backend.name
+        self.backend = backend
+        self.cache = cache
+
+    def recognize(self, audio) -> str:
+        key = self.cache.key(audio, self.backend)
+
+        text = self.cache.get(key)
+        if text is None:
+            text = self.backend.recognize(audio)
+            self.cache.put(key, text)
+
+        return text
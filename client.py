@@ -0,0 +1,345 @@
+import random
+import socket
+import threading
+import time
+from urllib.error import HTTPError, URLError
+import speech_recognition as sr
+from recognizer import RecognizerBackend
+from metrics import METRICS
+
+class RecognitionError(Exception):
+    """
+    Raised when an interval could not be recognized, with the reason
+    """
+    def __init__(self, reason, attempts=1):
+        """
+        Parameters:
+        -----------
+        reason : str
+            Why the interval has no text
+        attempts : int
+            The number of requests made for the interval
+        """
+        super().__init__("%s after %d attempts" % (reason, attempts))
+        self.reason = reason
+        self.attempts = attempts
+
+class TokenBucket:
+    """
+    Class used for limiting the rate of the requests
+
+    The bucket holds up to burst tokens and gets rate tokens per second,
+    every request takes one and waits when there is none.
+    """
+    def __init__(self, rate, burst=1):
+        """
+        Parameters:
+        -----------
+        rate : float
+            The requests per second
+        burst : int
+            The requests that can be made at once after a quiet period
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Takes a token, waiting for it if needed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+                self._time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveConcurrency:
+    """
+    Class used for adapting the number of requests in flight, AIMD style
+
+    The limit grows by one for every limit successful requests and is
+    halved when the service throttles or times out. The requests that
+    started before the last decrease do not decrease it again.
+    """
+    def __init__(self, initial=4, minimum=1, maximum=16, decrease=0.5):
+        """
+        Parameters:
+        -----------
+        initial : int
+            The limit to start with
+        minimum : int
+            The lowest limit
+        maximum : int
+            The highest limit
+        decrease : float
+            The limit is multiplied by this on congestion
+        """
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> float:
+        """
+        Waits until a request can be made
+
+        Returns:
+        --------
+        float : the start time of the request, given back to release
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, congested=False) -> None:
+        """
+        Ends a request
+
+        Parameters:
+        -----------
+        started : float
+            The value returned by acquire
+        congested : bool
+            True if the service throttled the request or timed out
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if congested:
+                if started >= self._decreased:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._decreased = time.monotonic()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            METRICS.set("recognizer_concurrency_limit", self.limit)
+            self._condition.notify_all()
+
+class CircuitBreaker:
+    """
+    Class used for pausing the requests while the service keeps failing
+
+    After failure_threshold failures in a row the circuit opens and the
+    requests wait for reset_timeout. Then a single request is let through,
+    and the circuit closes again if it succeeds.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=10.0, max_wait=60.0):
+        """
+        Parameters:
+        -----------
+        failure_threshold : int
+            The failures in a row that open the circuit
+        reset_timeout : float
+            The time the circuit stays open, in seconds
+        max_wait : float
+            The longest a request waits for the circuit, in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_wait = max_wait
+        self.failures = 0
+        self.opened = 0
+        self._open_until = None
+        self._probing = False
+        self._condition = threading.Condition()
+
+    def wait(self) -> bool:
+        """
+        Waits until a request can be made
+
+        Returns:
+        --------
+        bool : false if the circuit stayed open for max_wait
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._open_until is None:
+                    return True
+                if now >= self._open_until and not self._probing:
+                    # half open, this request checks if the service is back
+                    self._probing = True
+                    return True
+                if now >= deadline:
+                    return False
+
+                wait = deadline - now
+                if not self._probing:
+                    wait = min(wait, self._open_until - now)
+                self._condition.wait(max(wait, 0.001))
+
+    def success(self) -> None:
+        """
+        Records a successful request
+        """
+        with self._condition:
+            self.failures = 0
+            self._open_until = None
+            self._probing = False
+            self._condition.notify_all()
+
+    def failure(self) -> None:
+        """
+        Records a failed request
+        """
+        with self._condition:
+            self.failures += 1
+            if self._probing or (self._open_until is None and self.failures >= self.failure_threshold):
+                self._open_until = time.monotonic() + self.reset_timeout
+                self.opened += 1
+                METRICS.count("recognizer_circuit_opened")
+            self._probing = False
+            self._condition.notify_all()
+
+def classify(error) -> tuple:
+    """
+    Decides why a request failed and if it is worth trying again
+
+    Parameters:
+    -----------
+    error : Exception
+        The exception raised by the recognizer
+
+    Returns:
+    --------
+    tuple : the reason, true if the error is transient, and the delay the
+    service asked for, in seconds, or 0
+    """
+    if isinstance(error, sr.RequestError) and isinstance(error.__context__, (HTTPError, URLError,
+                                                                             socket.timeout, TimeoutError)):
+        # speech_recognition wraps the errors of the request, the Google one included
+        return classify(error.__context__)
+    if isinstance(error, sr.UnknownValueError):
+        return "no speech", False, 0
+    if isinstance(error, HTTPError):
+        retry_after = _seconds(error.headers.get("Retry-After") if error.headers else None)
+        if error.code == 429:
+            return "throttled", True, retry_after
+        if error.code in (408, 504):
+            return "timeout", True, retry_after
+        if error.code >= 500:
+            return "server error %d" % error.code, True, retry_after
+        return "rejected %d" % error.code, False, 0
+    if isinstance(error, (socket.timeout, TimeoutError)):
+        return "timeout", True, 0
+    if isinstance(error, URLError):
+        if isinstance(error.reason, (socket.timeout, TimeoutError)):
+            return "timeout", True, 0
+        return "connection failed", True, 0
+    if isinstance(error, (ConnectionError, sr.RequestError)):
+        return "connection failed", True, 0
+    return type(error).__name__, False, 0
+
+def is_transient(reason) -> bool:
+    """
+    Tells if the reason an interval has no text is transient, so sending
+    it again later can give a text, as opposed to no speech or a rejected
+    request
+
+    Parameters:
+    -----------
+    reason : str
+        The reason, as given by classify or RecognitionError
+
+    Returns:
+    --------
+    bool : true if the interval is worth sending again
+    """
+    return reason in ("throttled", "timeout", "connection failed", "circuit open") \
+        or reason.startswith("server error")
+
+def _seconds(value) -> float:
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+class ResilientBackend(RecognizerBackend):
+    """
+    A recognizer that calls the wrapped one with rate limiting, adaptive
+    concurrency, retries and a circuit breaker
+
+    Transient errors, like throttling, timeouts and server errors, are
+    tried again after an exponential backoff with full jitter, or after
+    the delay the service asked for, up to max_backoff. An interval that still fails raises
+    RecognitionError with the reason.
+    """
+    def __init__(self, backend, rate=None, burst=4, initial_concurrency=4, max_concurrency=16,
+                 retries=4, backoff=0.5, max_backoff=10.0, breaker=None, seed=None):
+        """
+        Parameters:
+        -----------
+        backend : RecognizerBackend
+            The recognizer to call
+        rate : float
+            The most requests per second, no limit by default
+        burst : int
+            The requests that can be made at once under the rate limit
+        initial_concurrency : int
+            The requests in flight to start with
+        max_concurrency : int
+            The most requests in flight
+        retries : int
+            The number of times a request is tried again
+        backoff : float
+            The first backoff, in seconds, doubled on every retry
+        max_backoff : float
+            The longest backoff, in seconds
+        breaker : CircuitBreaker
+            The circuit breaker, a default one if not given
+        seed : int
+            The seed of the jitter
+        """
+        super().__init__(backend.language)
+        self.name = backend.name
+        self.backend = backend
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, 1, max_concurrency)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._random = random.Random(seed)
+
+    def recognize(self, audio) -> str:
+        for attempt in range(self.retries + 1):
+            if not self.breaker.wait():
+                raise RecognitionError("circuit open", attempt)
+            if self.bucket is not None:
+                self.bucket.acquire()
+
+            started = self.concurrency.acquire()
+            try:
+                text = self.backend.recognize(audio)
+            except Exception as error:
+                reason, transient, retry_after = classify(error)
+                self.concurrency.release(started, congested=reason in ("throttled", "timeout"))
+                if not transient:
+                    # the service answered, so it is not failing
+                    self.breaker.success()
+                    raise RecognitionError(reason, attempt + 1) from error
+
+                self.breaker.failure()
+                if attempt == self.retries:
+                    raise RecognitionError(reason, attempt + 1) from error
+
+                METRICS.count("recognizer_retries", reason=reason)
+                delay = self._random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                time.sleep(max(delay, min(retry_after, self.max_backoff)))
+                continue
+
+            self.concurrency.release(started)
+            self.breaker.success()
+            return text
@@ -0,0 +1,62 @@
+import tkinter
+import cv2
+import numpy as np
+import PIL.Image, PIL.ImageTk
+
+class FrameDisplay:
+    """
+    Class used for showing video frames on a canvas
+
+    The canvas has a single image item for the whole playback and every
+    frame is pasted into its pixels, so nothing is added to the canvas per
+    frame. Scaled and converted frames are written into a buffer that is
+    kept for the whole playback, and overlays are drawn there, so the
+    frames of the decoder are never changed.
+    """
+    def __init__(self, canvas, width, height, bgr=False):
+        """
+        Parameters:
+        -----------
+        canvas : Canvas
+            The canvas to draw on
+        width : int
+            The width of the image
+        height : int
+            The height of the image
+        bgr : bool
+            True if the frames come in the BGR order of OpenCV
+        """
+        self.canvas = canvas
+        self.width = int(width)
+        self.height = int(height)
+        self.bgr = bgr
+
+        self.buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.photo = PIL.ImageTk.PhotoImage("RGB", (self.width, self.height))
+        self.item = canvas.create_image(0, 0, image = self.photo, anchor = tkinter.NW)
+
+    def show(self, frame, draw=None) -> None:
+        """
+        Shows a frame, scaled to the size of the image
+
+        Parameters:
+        -----------
+        frame : ndarray
+            The frame, left as it is
+        draw : callable
+            If given, called with the scaled frame to draw on it before it
+            is shown. The frame is only copied to the buffer for this when
+            it was not scaled or converted there already.
+        """
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height), dst = self.buffer,
+                               interpolation = cv2.INTER_LINEAR)
+        if self.bgr:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst = self.buffer)
+        if draw is not None:
+            if frame is not self.buffer:
+                np.copyto(self.buffer, frame)
+                frame = self.buffer
+            draw(frame)
+
+        self.photo.paste(PIL.Image.fromarray(frame))
@@ -1,10 +1,88 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from webrtcvad import Vad
 import speech_recognition as sr
-from numpy.fft import fft
-from audio import MonoAudioFile, Segment, StereoAudioFile
+from scipy.fft import rfft, rfftfreq
+from audio import FfmpegAudioStream, MonoAudioFile, PcmSpool, Segment, StereoAudioFile, downmix, resample, resample_chunks
+from recognizer import GoogleBackend, encode_audio, map_ordered
+from cache import CachedBackend
+from client import RecognitionError, ResilientBackend, is_transient
+from pipeline import Pipeline
+from metrics import METRICS
+from artifacts import STAGES
+from planner import JOINT_SILENCE, MAX_GAP, PADDING, compare_plans, frame_energy, plan_intervals, split_text
 
-def segment_generator(frame_duration_ms, data, sample_rate) -> list:
+DETECTORS = ("webrtc", "spectral", "both", "either")
+
+# the sample rate of the audio sent to the recognizer, enough for speech
+RECOGNIZER_SAMPLE_RATE = 16000
+
+def frame_blocks(frame_duration_ms, data, sample_rate, block_size=4096):
+    """
+    Splits the audio data into blocks of frames
+
+    Every block is a 2-D view over the samples, one frame per row, so no
+    object or copy is made per frame. Like in segment_generator, a frame
+    is only used when more data follows it.
+
+    Parameters:
+    -----------
+    frame_duration_ms : int
+        The frame duration is milliseconds
+    data : bytes or iterable
+        The audio data to be split, either as a whole or as a stream of
+        int16 chunks
+    sample_rate : int
+        The sample rate
+    block_size : int
+        The maximum number of frames in a block
+
+    Yields:
+    -------
+    tuple : the index of the first frame of the block and the block
+    """
+    frame_length = int(sample_rate * (frame_duration_ms / 1000.0))
+
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = [data]
+
+    # the samples of an incomplete frame are carried over to the next chunk
+    carry = np.zeros(0, dtype=np.int16)
+    index = 0
+    for chunk in data:
+        chunk = _as_samples(chunk)
+        if len(carry) > 0:
+            chunk = np.concatenate((carry, chunk))
+
+        n_frames = max(0, (len(chunk) - 1) // frame_length)
+        frames = chunk[:n_frames * frame_length].reshape(n_frames, frame_length)
+        for start in range(0, n_frames, block_size):
+            yield index + start, frames[start:start + block_size]
+        index += n_frames
+        carry = chunk[n_frames * frame_length:]
+
+def frame_times(first_index, n_frames, frame_duration_ms) -> np.ndarray:
+    """
+    Computes the starting times of consecutive frames
+
+    Parameters:
+    -----------
+    first_index : int
+        The index of the first frame
+    n_frames : int
+        The number of frames
+    frame_duration_ms : int
+        The frame duration is milliseconds
+
+    Returns:
+    --------
+    ndarray : the starting times in seconds
+    """
+    return np.arange(first_index, first_index + n_frames) * (frame_duration_ms / 1000.0)
+
+def segment_generator(frame_duration_ms, data, sample_rate):
     """
     Generates segments
 
@@ -12,26 +90,77 @@ def segment_generator(frame_duration_ms, data, sample_rate) -> list:
     -----------
     frame_duration_ms : int
         The frame duration is milliseconds
-    data : list
-        The audio data to be split
+    data : bytes or iterable
+        The audio data to be split, either as a whole or as a stream of
+        int16 chunks
     sample_rate : int
         The sample rate
+
+    Yields:
+    -------
+    Segment : the next segment
+    """
+    duration = int(sample_rate * (frame_duration_ms / 1000.0)) / sample_rate
+
+    for first_index, block in frame_blocks(frame_duration_ms, data, sample_rate):
+        timestamps = frame_times(first_index, len(block), frame_duration_ms)
+        for frame, timestamp in zip(block, timestamps):
+            yield Segment(memoryview(frame).cast('B'), float(timestamp), duration)
+
+def _as_samples(chunk) -> np.ndarray:
+    if isinstance(chunk, np.ndarray):
+        return np.ascontiguousarray(chunk, dtype=np.int16)
+    return np.frombuffer(chunk, np.int16)
+
+def spectral_speech_mask(frames, sample_rate, voice_freq=3500, threshold=0.4, block_size=16384) -> np.ndarray:
     """
-    # number of bytes that represent a segment
-    n_bytes = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
-    offset = 0
-    timestamp = 0.0
-    #in seconds
-    duration = (float(n_bytes) / sample_rate) / 2.0
-    result = []
-    while offset + n_bytes < len(data):
-        result.append(Segment(data[offset:offset + n_bytes], timestamp, duration))
-        timestamp += duration
-        offset += n_bytes
+    Decides for every frame if it is speech, based on the energy below voice_freq
+
+    The ratio is the same as the one computed over the full two sided
+    spectrum, only the positive half is computed and the mirrored bins
+    are counted twice.
+
+    Parameters:
+    -----------
+    frames : ndarray
+        The frames, one per row
+    sample_rate : int
+        The sample rate
+    voice_freq : int
+        The frequency under which the energy is counted as voice
+    threshold : float
+        The minimum ratio for a frame to be speech
+    block_size : int
+        The number of frames transformed at once
+
+    Returns:
+    --------
+    ndarray: true for the frames that are predicted as being speech
+    """
+    n_frames, frame_length = frames.shape
+    mask = np.zeros(n_frames, dtype=bool)
+    if frame_length == 0:
+        return mask
+
+    freq = rfftfreq(frame_length, 1 / sample_rate)
+    # bins that have a mirrored negative frequency are counted twice in the total
+    total_weights = np.full(len(freq), 2.0, dtype=np.float32)
+    total_weights[0] = 1.0
+    if frame_length % 2 == 0:
+        total_weights[-1] = 1.0
+    voice_weights = (freq < voice_freq).astype(np.float32)
+
+    for start in range(0, n_frames, block_size):
+        # single precision is plenty for a ratio and halves the transform time
+        magnitude = np.abs(rfft(frames[start:start + block_size].astype(np.float32), axis=1))
+        voice_freq_sum = magnitude @ voice_weights
+        all_freq_sum = magnitude @ total_weights
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mask[start:start + block_size] = (voice_freq_sum / all_freq_sum) > threshold
 
-    return result
+    return mask
 
-def is_speech(data) -> bool:
+def is_speech(data, sample_rate=16000) -> bool:
     """
     Decides if the audio data is speech
 
@@ -39,81 +168,479 @@ def is_speech(data) -> bool:
     -----------
     data : list
         The audio data
+    sample_rate : int
+        The sample rate
 
     Returns:
     --------
     bool: true, if the audio is predicted as being speech
     """
     x = np.frombuffer(data, np.int16)
-    X = fft(x)
+    return bool(spectral_speech_mask(x.reshape(1, -1), sample_rate)[0])
 
-    N = len(X)
-    n = np.arange(N)
-    T = N/16000
-    freq = n/T
+def webrtc_speech_mask(frames, sample_rate, vad=None, aggressiveness=3) -> np.ndarray:
+    """
+    Decides for every frame if it is speech using webrtcvad
 
-    all_freq_sum = 0
-    voice_freq_sum = 0
-    
-    # Sum all the samples below 3500 Hz
-    for i in range(0, N):
-        if freq[i] < 3500:
-            voice_freq_sum += np.abs(X[i])
-        all_freq_sum += np.abs(X[i])
-
-    # make the decision based on the threshold
-    if (voice_freq_sum / all_freq_sum) > 0.4:
-        return True
-    else:
-        return False
+    Parameters:
+    -----------
+    frames : ndarray
+        The frames, one per row
+    sample_rate : int
+        The sample rate
+    vad : Vad
+        The detector to use, so that its state is kept between calls
+    aggressiveness : int
+        The webrtcvad mode, from 0 to 3, used when no vad is given
+
+    Returns:
+    --------
+    ndarray: true for the frames that are predicted as being speech
+    """
+    if vad is None:
+        vad = Vad(aggressiveness)
+
+    mask = np.zeros(len(frames), dtype=bool)
+    if len(frames) == 0:
+        return mask
+
+    # one byte view over the whole block, sliced per frame
+    data = memoryview(np.ascontiguousarray(frames)).cast('B')
+    n_bytes = frames.shape[1] * 2
+    for i in range(len(frames)):
+        mask[i] = vad.is_speech(data[i * n_bytes:(i + 1) * n_bytes], sample_rate)
+
+    return mask
+
+def speech_masks(data, sample_rate, frame_duration=10, detector="webrtc", aggressiveness=3,
+                 block_size=4096):
+    """
+    Decides for every frame if it is speech, block by block
+
+    Parameters:
+    -----------
+    data : bytes or iterable
+        The data to be processed, as a whole or as a stream of int16 chunks
+    sample_rate : int
+        The sample rate
+    frame_duration : int
+        The frame duration in milliseconds
+    detector : str
+        "webrtc", "spectral", "both" (a frame must pass both detectors)
+        or "either" (a frame must pass one of them)
+    aggressiveness : int
+        The webrtcvad mode, from 0 (least) to 3 (most aggressive)
+    block_size : int
+        The number of frames checked at once
+
+    Yields:
+    -------
+    tuple : the index of the first frame of the block and its speech mask
+    """
+    if detector not in DETECTORS:
+        raise ValueError("Unknown detector: " + str(detector))
+
+    vad = Vad(aggressiveness)
+
+    for first_index, block in frame_blocks(frame_duration, data, sample_rate, block_size):
+        with METRICS.span("vad"):
+            if detector == "spectral":
+                speech = spectral_speech_mask(block, sample_rate)
+            else:
+                speech = webrtc_speech_mask(block, sample_rate, vad)
+                if detector == "both":
+                    speech &= spectral_speech_mask(block, sample_rate)
+                elif detector == "either":
+                    speech |= spectral_speech_mask(block, sample_rate)
+        METRICS.count("frames", len(speech))
+
+        yield first_index, speech
+
+def speech_frame_mask(data, sample_rate, frame_duration=10, detector="webrtc", aggressiveness=3) -> np.ndarray:
+    """
+    Decides for every frame of the data if it is speech
+
+    Parameters:
+    -----------
+    data : bytes or iterable
+        The data to be processed, as a whole or as a stream of int16 chunks
+    sample_rate : int
+        The sample rate
+    frame_duration : int
+        The frame duration in milliseconds
+    detector : str
+        The speech detector, see speech_masks
+    aggressiveness : int
+        The webrtcvad mode, from 0 (least) to 3 (most aggressive)
+
+    Returns:
+    --------
+    ndarray : true for the frames that are speech
+    """
+    masks = [mask for _, mask in speech_masks(data, sample_rate, frame_duration, detector, aggressiveness)]
+    if len(masks) == 0:
+        return np.zeros(0, dtype=bool)
+
+    return np.concatenate(masks)
 
-def detect_audio_segment(data, sample_rate, frame_duration=10):
+def window_speech_counts(mask, frame_duration=10, window_duration=0.5, first_index=0) -> tuple:
+    """
+    Counts the speech frames in every window
+
+    Parameters:
+    -----------
+    mask : ndarray
+        The speech mask of consecutive frames
+    frame_duration : int
+        The frame duration in milliseconds
+    window_duration : float
+        The window duration in seconds
+    first_index : int
+        The index of the first frame of the mask
+
+    Returns:
+    --------
+    tuple : the index of the first window and the counts from that window on
+    """
+    indices = first_index + np.flatnonzero(mask)
+    if len(indices) == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+
+    # a frame belongs to the window its start time falls in
+    windows = (indices * frame_duration) // int(round(window_duration * 1000))
+    first_window = int(windows[0])
+
+    return first_window, np.bincount(windows - first_window)
+
+def speech_windows(counts, frame_duration=10, window_duration=0.5, min_speech_ratio=0.3,
+                   first_window=0) -> list:
+    """
+    Selects the windows with enough speech
+
+    Parameters:
+    -----------
+    counts : ndarray
+        The number of speech frames in every window, from the first one
+    frame_duration : int
+        The frame duration in milliseconds
+    window_duration : float
+        The window duration in seconds
+    min_speech_ratio : float
+        The part of a window that must be speech, a window is kept when
+        its ratio is above it
+    first_window : int
+        The index of the window of the first count
+
+    Returns:
+    --------
+    list : the starting times of the windows that contain speech
+    """
+    timestamps = _speech_window_times(counts, frame_duration, window_duration, min_speech_ratio,
+                                      first_window)
+    METRICS.count("speech_windows", len(timestamps))
+
+    return timestamps
+
+def _speech_window_times(counts, frame_duration, window_duration, min_speech_ratio, first_window=0) -> list:
+    frames_per_window = window_duration * 1000 / frame_duration
+    windows = first_window + np.flatnonzero(np.asarray(counts) > min_speech_ratio * frames_per_window)
+
+    return (windows * window_duration).tolist()
+
+def speech_timestamps(mask, frame_duration=10, window_duration=0.5, min_speech_ratio=0.3) -> list:
+    """
+    Computes the speech timestamps from a full speech mask
+
+    This is much faster than the detection, so it can be used to tune the
+    window parameters on a mask that was computed once.
+
+    Parameters:
+    -----------
+    mask : ndarray
+        The speech mask of all the frames
+    frame_duration : int
+        The frame duration in milliseconds
+    window_duration : float
+        The window duration in seconds
+    min_speech_ratio : float
+        The part of a window that must be speech
+
+    Returns:
+    --------
+    list : the timestamps of the windows that contain speech
+    """
+    timestamps = _mask_timestamps(mask, frame_duration, window_duration, min_speech_ratio)
+    METRICS.count("speech_windows", len(timestamps))
+
+    return timestamps
+
+def _mask_timestamps(mask, frame_duration=10, window_duration=0.5, min_speech_ratio=0.3) -> list:
+    # speech_timestamps without the metrics, for plans that are only compared
+    first_window, counts = window_speech_counts(mask, frame_duration, window_duration)
+    counts = np.concatenate((np.zeros(first_window, dtype=np.int64), counts))
+
+    return _speech_window_times(counts, frame_duration, window_duration, min_speech_ratio)
+
+def speech_timestamp_generator(data, sample_rate, frame_duration=10, detector="webrtc",
+                               block_size=4096, window_duration=0.5, min_speech_ratio=0.3,
+                               aggressiveness=3):
+    """
+    Detects the segments that contain speech, yielding every timestamp as
+    soon as its window has been fully processed
+
+    Parameters:
+    -----------
+    data : bytes or iterable
+        The data to be processed, as a whole or as a stream of int16 chunks
+    sample_rate : int
+        The sample rate
+    frame_duration : int
+        The frame duration in milliseconds
+    detector : str
+        The speech detector, see speech_masks
+    block_size : int
+        The number of frames checked at once
+    window_duration : float
+        The length of the windows the speech frames are counted in, in seconds
+    min_speech_ratio : float
+        The part of a window that must be speech
+    aggressiveness : int
+        The webrtcvad mode, from 0 (least) to 3 (most aggressive)
+
+    Yields:
+    -------
+    float : the timestamps of the segments that contain speech
+    """
+    masks = speech_masks(data, sample_rate, frame_duration, detector, aggressiveness, block_size)
+
+    return mask_timestamp_generator(masks, frame_duration, window_duration, min_speech_ratio)
+
+def mask_timestamp_generator(masks, frame_duration=10, window_duration=0.5, min_speech_ratio=0.3):
+    """
+    Computes the speech timestamps from the speech masks of consecutive
+    blocks, yielding every timestamp as soon as its window is complete
+
+    Parameters:
+    -----------
+    masks : iterable
+        The index of the first frame and the speech mask of every block,
+        as yielded by speech_masks
+    frame_duration : int
+        The frame duration in milliseconds
+    window_duration : float
+        The length of the windows the speech frames are counted in, in seconds
+    min_speech_ratio : float
+        The part of a window that must be speech
+
+    Yields:
+    -------
+    float : the timestamps of the segments that contain speech
+    """
+    window_ms = int(round(window_duration * 1000))
+    # counts[0] is the count of the window first_window
+    counts = np.zeros(0, dtype=np.int64)
+    first_window = 0
+
+    for first_index, speech in masks:
+        block_window, block_counts = window_speech_counts(speech, frame_duration, window_duration,
+                                                          first_index)
+        if len(block_counts) > 0:
+            counts = _add_counts(counts, block_window - first_window, block_counts)
+
+        # the windows before the one of the next frame are complete
+        done = ((first_index + len(speech)) * frame_duration) // window_ms - first_window
+        if done > 0:
+            yield from speech_windows(counts[:done], frame_duration, window_duration,
+                                      min_speech_ratio, first_window)
+            counts = counts[done:]
+            first_window += done
+
+    yield from speech_windows(counts, frame_duration, window_duration, min_speech_ratio, first_window)
+
+def detect_audio_segment(data, sample_rate, frame_duration=10, detector="webrtc", block_size=4096,
+                         window_duration=0.5, min_speech_ratio=0.3, aggressiveness=3):
     """
     Detects all the segments that contain speech
 
+    The frames are processed in blocks as they are generated, so the data
+    can be a stream of chunks and is never held in memory as a whole. Only
+    the number of speech frames per window is kept.
+
     Parameters:
     -----------
-    data : list
+    data : bytes or iterable
+        The data to be processed, as a whole or as a stream of int16 chunks
+    sample_rate : int
+        The sample rate
+    frame_duration : int
+        The frame duration in milliseconds
+    detector : str
+        "webrtc", "spectral", "both" (a frame must pass both detectors)
+        or "either" (a frame must pass one of them)
+    block_size : int
+        The number of frames checked at once
+    window_duration : float
+        The length of the windows the speech frames are counted in, in seconds
+    min_speech_ratio : float
+        The part of a window that must be speech
+    aggressiveness : int
+        The webrtcvad mode, from 0 (least) to 3 (most aggressive)
+
+    Returns:
+    --------
+    list : the timestamps of the segments that contain speech
+    """
+    return list(speech_timestamp_generator(data, sample_rate, frame_duration, detector, block_size,
+                                           window_duration, min_speech_ratio, aggressiveness))
+
+def _add_counts(counts, first_window, window_counts) -> np.ndarray:
+    end = first_window + len(window_counts)
+    if end > len(counts):
+        counts = np.concatenate((counts, np.zeros(end - len(counts), dtype=np.int64)))
+    counts[first_window:end] += window_counts
+
+    return counts
+
+def _detect_shard(shard) -> tuple:
+    data, first_index, skip, sample_rate, frame_duration, detector, aggressiveness, window_duration = shard
+
+    mask = speech_frame_mask(data, sample_rate, frame_duration, detector, aggressiveness)[skip:]
+
+    return window_speech_counts(mask, frame_duration, window_duration, first_index)
+
+def detect_audio_segment_sharded(data, sample_rate, frame_duration=10, detector="webrtc",
+                                 window_duration=0.5, min_speech_ratio=0.3, aggressiveness=3,
+                                 shard_duration=60.0, overlap_duration=30.0, max_workers=None):
+    """
+    Detects all the segments that contain speech on several processes
+
+    The data is split into shards of shard_duration seconds. Every shard is
+    detected from overlap_duration seconds before its start, so that the
+    detector has adapted to the audio when the shard begins, and only the
+    frames of the shard itself are counted. The window counts of the shards
+    are added together, so windows across a shard boundary are counted the
+    same as in one run.
+
+    The shards only depend on shard_duration, so the timestamps are the
+    same for any number of workers, one included. webrtcvad adapts to the
+    audio over a long time, so they can differ slightly from
+    detect_audio_segment, the spectral detector gives the same result.
+
+    Parameters:
+    -----------
+    data : bytes
         The data to be processed
     sample_rate : int
         The sample rate
     frame_duration : int
         The frame duration in milliseconds
+    detector : str
+        The speech detector, see speech_masks
+    window_duration : float
+        The length of the windows the speech frames are counted in, in seconds
+    min_speech_ratio : float
+        The part of a window that must be speech
+    aggressiveness : int
+        The webrtcvad mode, from 0 (least) to 3 (most aggressive)
+    shard_duration : float
+        The length of a shard in seconds
+    overlap_duration : float
+        The audio detected before every shard, in seconds
+    max_workers : int
+        The number of processes, all the cores by default
 
     Returns:
     --------
     list : the timestamps of the segments that contain speech
     """
-    vad = Vad(3)
-    
-    frames = segment_generator(frame_duration, data, sample_rate)
-    frames = list(frames)
+    samples = np.frombuffer(data, np.int16)
+    frame_length = int(sample_rate * (frame_duration / 1000.0))
+    # as in frame_blocks, the last frame is only used when data follows it
+    n_frames = max(0, (len(samples) - 1) // frame_length)
 
-    vad_segment = []
-    for i, frame in enumerate(frames):
-        is_speech1 = vad.is_speech(frame.data, sample_rate)
-        if is_speech1:
-            vad_segment.append([frame.timestamp, frame.timestamp+frame.duration])
+    shard_frames = max(1, int(round(shard_duration * 1000 / frame_duration)))
+    overlap_frames = int(round(overlap_duration * 1000 / frame_duration))
 
-    if len(vad_segment) == 0:
-        return []
+    shards = []
+    for first_index in range(0, n_frames, shard_frames):
+        end_index = min(first_index + shard_frames, n_frames)
+        start_index = max(0, first_index - overlap_frames)
+        shard_samples = samples[start_index * frame_length : end_index * frame_length + 1]
+        shards.append((shard_samples.tobytes(), first_index, first_index - start_index, sample_rate,
+                       frame_duration, detector, aggressiveness, window_duration))
 
-    start_time = 0
-    duration_s = 0.5
-    counter = 0
-    
-    timestamps = []
-    
-    for x in vad_segment:
-        if (x[1] < (start_time + duration_s)):
-            counter = counter + 1
+    if max_workers == 1 or len(shards) <= 1:
+        results = [_detect_shard(shard) for shard in shards]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_detect_shard, shards))
+
+    counts = np.zeros(0, dtype=np.int64)
+    for first_window, shard_counts in results:
+        counts = _add_counts(counts, first_window, shard_counts)
+
+    return speech_windows(counts, frame_duration, window_duration, min_speech_ratio)
+
+def interval_generator(timestamps, max_pause=0.5, max_time=4.0, window_duration=0.5):
+    """
+    Generates the speech intervals based on timestamps, yielding every
+    interval as soon as it is closed
+
+    Parameters:
+    -----------
+    timestamps : iterable
+        The timestamps that indicate a speech segment, can be a generator
+    max_pause : float
+        The longest pause inside an interval, in seconds
+    max_time : float
+        The longer runs of speech are split in intervals of at most this length
+    window_duration : float
+        The length of the speech segment of a timestamp
+
+    Yields:
+    -------
+    list: the next interval
+    """
+    for interval in _intervals(timestamps, max_pause, max_time, window_duration):
+        METRICS.count("intervals")
+        yield interval
+
+def _intervals(timestamps, max_pause=0.5, max_time=4.0, window_duration=0.5):
+    # interval_generator without the metrics, for plans that are only compared
+    t1 = None
+    t2 = None
+    previous = None
+
+    for timestamp in timestamps:
+        if previous is not None and timestamp - previous <= max_pause:
+            t2 = timestamp + window_duration
         else:
-            if counter > 15:
-                timestamps.append(start_time)
-            counter = 0
-            start_time = start_time + duration_s
-    
-    return timestamps
+            if t1 is not None:
+                yield from _close_run(t1, t2, max_time, window_duration)
+            t1 = timestamp
+            t2 = timestamp + window_duration
+        previous = timestamp
+
+    if t1 is not None:
+        yield from _close_run(t1, t2, max_time, window_duration)
+
+def _close_run(t1, t2, max_time, window_duration):
+    if t2 - t1 == window_duration:
+        # a lone segment is padded so the recognizer gets enough audio
+        yield [t1, t2 + window_duration]
+        return
+
+    duration = t2 - t1
+    n_intervals = (int) ((duration / max_time) + 1)
+    mini_segment_duration = duration / n_intervals
+
+    t1_mini = t1
+
+    for j in range(0, n_intervals-1):
+        t2_mini = round(t1_mini + mini_segment_duration)
+        yield [t1_mini, t2_mini]
+        t1_mini = t2_mini
+    yield [t1_mini, t2]
 
 def generate_intervals(timestamps) -> list:
     """
@@ -128,39 +655,106 @@ def generate_intervals(timestamps) -> list:
     --------
     list: the intervals
     """
-    t1 = timestamps[0]
-    t2 = timestamps[0]
+    return list(interval_generator(timestamps))
 
-    max_pause = 0.5
-    max_time = 4.0
-    intervals = []
+def audio_frame_energy(audio_object, frame_duration=10, chunk_frames=1 << 20) -> np.ndarray:
+    """
+    Computes the energy of every frame of the audio, see planner.frame_energy
 
-    for i in range(1, len(timestamps)):
-        if timestamps[i] - timestamps[i-1] <= max_pause:
-            t2 = timestamps[i] + 0.5
-        else:
-            if t2 - t1 == 0.5:
-                intervals.append([t1, t2 + 0.5])
-                t1 = timestamps[i]
-            else:
-                duration = t2 - t1
-                if duration <= 0:
-                    continue
-                n_intervals = (int) ((duration / max_time) + 1)
-                mini_segment_duration = duration / n_intervals
+    Parameters:
+    -----------
+    audio_object : StereoAudioFile, MonoAudioFile or PcmSpool
+        The audio, in memory or read chunk by chunk
+    frame_duration : int
+        The frame duration in milliseconds
+    chunk_frames : int
+        The number of samples read at once when the audio is not in memory
 
-                t1_mini = t1
+    Returns:
+    --------
+    ndarray : the energy of every frame
+    """
+    frame_length = int(audio_object.sample_rate * (frame_duration / 1000.0))
+    if audio_object.channels is not None:
+        return frame_energy(downmix(audio_object.channels), frame_length)
 
-                for j in range(0, n_intervals-1):
-                    t2_mini = round(t1_mini + mini_segment_duration)
-                    intervals.append([t1_mini, t2_mini])
-                    t1_mini = t2_mini
-                intervals.append([t1_mini, t2])
-                t1 = timestamps[i]
+    chunk_frames -= chunk_frames % frame_length
+    energies = [np.zeros(0)]
+    start = 0
+    while True:
+        samples = downmix(audio_object.read_interval(start, start + chunk_frames))
+        if len(samples) == 0:
+            break
+        energies.append(frame_energy(samples, frame_length))
+        start += chunk_frames
 
-    return intervals
+    return np.concatenate(energies)
 
-def save_interval_audio(stereo_object, interval, file_name) -> None:
+def plan_speech_intervals(mask, audio_object, frame_duration=10, max_pause=0.5, max_duration=8.0,
+                          timestamps=None) -> tuple:
+    """
+    Plans the recognizer intervals with planner.plan_intervals and compares
+    them with the intervals of generate_intervals
+
+    Parameters:
+    -----------
+    mask : ndarray
+        The speech mask of all the frames
+    audio_object : StereoAudioFile, MonoAudioFile or PcmSpool
+        The audio, for the energy of the frames
+    frame_duration : int
+        The frame duration in milliseconds
+    max_pause : float
+        The longest pause inside a run of speech, in seconds
+    max_duration : float
+        The longest interval, in seconds
+    timestamps : list
+        The speech timestamps of the mask if they were already computed
+
+    Returns:
+    --------
+    tuple : the intervals and the report of planner.compare_plans
+    """
+    energy = audio_frame_energy(audio_object, frame_duration)
+    intervals = plan_intervals(mask, energy, frame_duration, max_pause=max_pause, max_duration=max_duration)
+    METRICS.count("intervals", len(intervals))
+
+    # the plan of generate_intervals is only compared, so it is not counted
+    if timestamps is None:
+        timestamps = _mask_timestamps(mask, frame_duration)
+    baseline = list(_intervals(timestamps))
+
+    report = compare_plans(intervals, baseline)
+    METRICS.count("planner_requests_saved", report["requests_saved"])
+    METRICS.count("planner_audio_seconds_saved", report["audio_seconds_saved"])
+
+    return intervals, report
+
+def interval_channels(stereo_object, interval) -> np.ndarray:
+    """
+    Extracts the audio of an interval
+
+    Parameters:
+    -----------
+    stereo_object : StereoAudioFile
+        The stero object that contains the interval to be processed
+    interval : list
+        The time points of the segment
+
+    Returns:
+    --------
+    ndarray : the channel data of the interval, one channel per row
+    """
+    start_frame = (int) (interval[0] * stereo_object.sample_rate)
+    end_frame = (int) (interval[1] * stereo_object.sample_rate)
+    
+    if stereo_object.channels is None:
+        # streaming mode, only the interval is read from the file
+        return stereo_object.read_interval(start_frame, end_frame)
+
+    return stereo_object.channels[:, start_frame : end_frame]
+
+def save_interval_audio(stereo_object, interval, file_name, sample_rate=RECOGNIZER_SAMPLE_RATE) -> None:
     """
     Saves the audio given to be send for speech recognition
 
@@ -171,37 +765,185 @@ def save_interval_audio(stereo_object, interval, file_name) -> None:
     interval : list
         The time points of the segment
     file_name : str
-        The file name in which the data will be saved
+        The file name in which the data will be saved, a flac file if it
+        ends with .flac and a wav file otherwise
+    sample_rate : int
+        The sample rate of the saved audio
     """
-    start_frame = (int) (interval[0] * stereo_object.n_frames / stereo_object.duration)
-    end_frame = (int) (interval[1] * stereo_object.n_frames / stereo_object.duration)
-    
-    new_channels = stereo_object.channels[:, start_frame : end_frame]
-    
-    interval_file = StereoAudioFile(file_name)
-    interval_file.write(new_channels.T, 2, 44100)
+    audio = interval_audio(stereo_object, interval, sample_rate)
+
+    with open(file_name, "wb") as f:
+        f.write(encode_audio(audio, "flac" if file_name.endswith(".flac") else "wav"))
 
-def generate_interval_subtitle(stereo_object, interval) -> None:
+def interval_audio(stereo_object, interval, sample_rate=RECOGNIZER_SAMPLE_RATE) -> sr.AudioData:
+    """
+    Builds the recognizer audio of an interval in memory
+
+    Parameters:
+    -----------
+    stereo_object : StereoAudioFile
+        The stero object that contains the interval to be processed, the
+        16 kHz mono audio of the speech detection when there is one, so
+        nothing has to be resampled
+    interval : list
+        The time points of the segment, and for a planned interval made of
+        more parts, the parts as a third item
+    sample_rate : int
+        The sample rate of the audio, never above the rate of the source.
+        None keeps the rate of the source
+
+    Returns:
+    --------
+    AudioData : the mono audio of the interval
+    """
+    if len(interval) > 2:
+        # the parts of a planned interval, joined by a short silence
+        silence = np.zeros((int) (JOINT_SILENCE * stereo_object.sample_rate), dtype=np.int16)
+        pieces = []
+        for part in interval[2]:
+            pieces += [downmix(interval_channels(stereo_object, part)), silence]
+        mono = np.concatenate(pieces[:-1])
+    else:
+        mono = downmix(interval_channels(stereo_object, interval))
+
+    if sample_rate is None or sample_rate >= stereo_object.sample_rate:
+        return sr.AudioData(mono.tobytes(), stereo_object.sample_rate, 2)
+    return sr.AudioData(resample(mono, stereo_object.sample_rate, sample_rate).tobytes(), sample_rate, 2)
+
+def generate_interval_subtitle(stereo_object, interval, recognizer=None,
+                               sample_rate=RECOGNIZER_SAMPLE_RATE) -> None:
     """
     Calls the recognizer
 
+    Nothing is written to disk, so the function can be called from many
+    threads or processes at once.
+
     Parameters:
     -----------
     stereo_object : StereoAudioFile
         The audio to be processed
     interval : list
         The interval to be processed
+    recognizer : RecognizerBackend
+        The recognizer, Google by default
+    sample_rate : int
+        The sample rate of the audio sent, see interval_audio
     """
-    save_interval_audio(stereo_object, interval, "./media/temp.wav")
-    
-    r = sr.Recognizer()
-    with sr.AudioFile("./media/temp.wav") as source:
-        audio = r.record(source)
-    text = r.recognize_google(audio)
+    if recognizer is None:
+        recognizer = GoogleBackend()
+
+    text = recognizer.recognize(interval_audio(stereo_object, interval, sample_rate))
     
     return interval, text
 
-def generate_subtitles(audio_file) -> list:
+def recognize_intervals(stereo_object, intervals, recognizer=None, max_workers=4,
+                        sample_rate=RECOGNIZER_SAMPLE_RATE):
+    """
+    Recognizes the intervals concurrently
+
+    Parameters:
+    -----------
+    stereo_object : StereoAudioFile
+        The audio to be processed
+    intervals : iterable
+        The intervals to be processed
+    recognizer : RecognizerBackend
+        The recognizer, Google by default
+    max_workers : int
+        The number of requests in flight
+    sample_rate : int
+        The sample rate of the audio sent, see interval_audio
+
+    Yields:
+    -------
+    the subtitles, in the order of the intervals. An interval that could
+    not be recognized gets an empty text and the reason as a third item.
+    A planned interval made of more parts is sent in one request and gives
+    a subtitle for every part, see planner.split_text.
+    """
+    if recognizer is None:
+        recognizer = GoogleBackend()
+
+    def recognize(interval):
+        start = time.perf_counter()
+        try:
+            subtitle = generate_interval_subtitle(stereo_object, interval, recognizer, sample_rate)
+        except Exception as error:
+            reason = error.reason if isinstance(error, RecognitionError) else type(error).__name__
+            METRICS.count("recognizer_calls")
+            METRICS.count("recognizer_failures", reason=reason)
+            return [[part, "", reason] for part in _parts(interval)]
+
+        METRICS.count("recognizer_calls")
+        METRICS.observe("recognizer_latency_seconds", time.perf_counter() - start)
+        if len(interval) > 2:
+            parts = interval[2]
+            return [[part, text] for part, text in zip(parts, split_text(subtitle[1], parts)) if text]
+        return [subtitle]
+
+    for subtitles in map_ordered(recognize, intervals, max_workers):
+        yield from subtitles
+
+def _parts(interval) -> list:
+    return interval[2] if len(interval) > 2 else [interval]
+
+def prepare_speech_audio(stereo_object, sample_rate=16000, debug_dir=None) -> MonoAudioFile:
+    """
+    Downmixes and resamples the audio in memory for speech detection
+
+    Parameters:
+    -----------
+    stereo_object : StereoAudioFile
+        The audio that was read
+    sample_rate : int
+        The sample rate needed by the VAD
+    debug_dir : str
+        If given, the mono and resampled audio are also written there
+
+    Returns:
+    --------
+    MonoAudioFile : the resampled mono audio, kept in memory
+    """
+    mono_audio_file = MonoAudioFile(None)
+    mono_audio_file.load(stereo_object.sample_rate, stereo_object.convert_to_mono())
+
+    if debug_dir is not None:
+        MonoAudioFile(os.path.join(debug_dir, "audio_mono.wav")).write(
+            mono_audio_file.sample_rate, mono_audio_file.samples)
+
+    mono_audio_file.resample(sample_rate)
+
+    if debug_dir is not None:
+        MonoAudioFile(os.path.join(debug_dir, "audio_mono_resampled.wav")).write(
+            sample_rate, mono_audio_file.samples)
+
+    return mono_audio_file
+
+def stream_speech_audio(stereo_object, sample_rate=16000, chunk_frames=65536):
+    """
+    Downmixes and resamples the audio chunk by chunk for speech detection
+
+    Parameters:
+    -----------
+    stereo_object : StereoAudioFile
+        The audio to be streamed
+    sample_rate : int
+        The sample rate needed by the VAD
+    chunk_frames : int
+        The number of frames read at once
+
+    Returns:
+    --------
+    generator : the resampled mono chunks
+    """
+    stereo_object.read_header()
+    mono_chunks = (downmix(channels) for channels in stereo_object.read_chunks(chunk_frames))
+
+    return resample_chunks(mono_chunks, stereo_object.sample_rate, sample_rate)
+
+def generate_subtitles(audio_file, debug_dir=None, detector="webrtc", streaming=False,
+                       memory_map=False, recognizer=None, max_workers=4, cache=None,
+                       vad_workers=None) -> list:
     """
     Generates subtitiles from the audio file
 
@@ -209,32 +951,315 @@ def generate_subtitles(audio_file) -> list:
     ----------
     audio_file : str
         The name of the audio file
+    debug_dir : str
+        If given, the intermediate audio files are written there
+    detector : str
+        The speech detector, see detect_audio_segment
+    streaming : bool
+        If true, the audio is read in chunks and never held in memory,
+        debug_dir is ignored
+    memory_map : bool
+        If true, the audio file is mapped in memory instead of being read,
+        so the intervals only load the bytes they use
+    recognizer : RecognizerBackend
+        The recognizer, Google by default
+    max_workers : int
+        The number of recognizer requests in flight
+    cache : TranscriptionCache
+        If given, intervals already recognized are taken from the cache
+    vad_workers : int
+        If given, the speech detection is sharded on that many processes,
+        see detect_audio_segment_sharded. Not used when streaming
 
     Returns:
     --------
     list : the subtitles generated
     """
     main_audio_file = StereoAudioFile(audio_file)
-    main_audio_file.read()
-
-    mono_audio_file = MonoAudioFile("./media/audio_mono.wav")
-    mono_data = main_audio_file.convert_to_mono()
-    mono_audio_file.write(44100,  mono_data)
-    mono_audio_file.resample_and_save("./media/audio_mono_resampled.wav", 44100, 16000)
 
-    mono_resampled_file = MonoAudioFile("./media/audio_mono_resampled.wav")
-    mono_resampled_file.read()
+    if streaming:
+        if memory_map:
+            main_audio_file.read(memory_map=True)
+        chunks = stream_speech_audio(main_audio_file, 16000)
+        return list(subtitle_stream(chunks, main_audio_file, 16000, detector, recognizer,
+                                    max_workers, cache))
 
-    timestamps = detect_audio_segment(mono_resampled_file.data, 16000)
+    main_audio_file.read(memory_map)
+    mono_resampled_file = prepare_speech_audio(main_audio_file, 16000, debug_dir)
+    if vad_workers is None:
+        timestamps = detect_audio_segment(mono_resampled_file.data, mono_resampled_file.sample_rate,
+                                          detector=detector)
+    else:
+        timestamps = detect_audio_segment_sharded(mono_resampled_file.data,
+                                                  mono_resampled_file.sample_rate,
+                                                  detector=detector, max_workers=vad_workers)
 
     intervals = generate_intervals(timestamps)
-    
-    output = []
 
-    for interval in intervals:
-        try:
-            output.append(generate_interval_subtitle(main_audio_file, interval))
-        except:
-            output.append([interval, ""])
-    
-    return output
\ No newline at end of file
+    # the requests are built from the resampled mono audio, not from the source
+    return list(recognize_intervals(mono_resampled_file, intervals, _backend(recognizer, cache, max_workers),
+                                    max_workers))
+
+def media_subtitle_stream(media_file, work_dir, ffmpeg="ffmpeg", detector="webrtc",
+                          recognizer=None, max_workers=4, cache=None):
+    """
+    Generates subtitiles from any media file, decoding its audio through
+    an ffmpeg pipe
+
+    The speech detection runs while ffmpeg is decoding and the subtitles
+    are yielded as soon as they are recognized. Only the 16 kHz mono audio
+    is kept on disk, for the recognizer.
+
+    Parameters:
+    ----------
+    media_file : str
+        The name of the media file
+    work_dir : str
+        The directory where the 16 kHz audio is kept
+    ffmpeg : str
+        The ffmpeg executable
+    detector : str
+        The speech detector, see detect_audio_segment
+    recognizer : RecognizerBackend
+        The recognizer, Google by default
+    max_workers : int
+        The number of recognizer requests in flight
+    cache : TranscriptionCache
+        If given, intervals already recognized are taken from the cache
+
+    Yields:
+    -------
+    the subtitles, in order
+    """
+    stream = FfmpegAudioStream(media_file, 16000, 1, ffmpeg)
+    spool = PcmSpool(os.path.join(work_dir, "speech.pcm"), 16000, 1)
+    try:
+        yield from subtitle_stream(spool.tee(stream.read_chunks()), spool, 16000, detector,
+                                   recognizer, max_workers, cache)
+    finally:
+        spool.close()
+
+def generate_media_subtitles(media_file, work_dir, ffmpeg="ffmpeg", detector="webrtc",
+                             recognizer=None, max_workers=4, cache=None) -> list:
+    """
+    Generates subtitiles from any media file, see media_subtitle_stream
+
+    Returns:
+    --------
+    list : the subtitles generated
+    """
+    return list(media_subtitle_stream(media_file, work_dir, ffmpeg, detector, recognizer,
+                                      max_workers, cache))
+
+def stored_subtitle_stream(media_file, store, ffmpeg="ffmpeg", detector="webrtc", aggressiveness=3,
+                           window_duration=0.5, min_speech_ratio=0.3, max_pause=0.5, max_time=4.0,
+                           recognizer=None, max_workers=4, cache=None, queue_size=64, planner=False,
+                           max_duration=8.0):
+    """
+    Generates subtitiles from any media file, keeping the output of every
+    stage in an artifact store
+
+    The stages that have a stored artifact for the same input and
+    parameters are skipped, and the stages after them run as a pipeline
+    like in subtitle_stream. A stage is only used from the store when all
+    the stages before it are, so when the 16 kHz audio has to be decoded
+    again everything is computed again. The artifacts are stored when the
+    subtitles are complete, the transcripts only when no text is empty.
+
+    Parameters:
+    ----------
+    media_file : str
+        The name of the media file
+    store : ArtifactStore
+        The artifact store
+    ffmpeg : str
+        The ffmpeg executable
+    detector : str
+        The speech detector, see speech_masks
+    aggressiveness : int
+        The webrtcvad mode, from 0 (least) to 3 (most aggressive)
+    window_duration : float
+        The length of the windows the speech frames are counted in, in seconds
+    min_speech_ratio : float
+        The part of a window that must be speech
+    max_pause : float
+        The longest pause inside an interval, in seconds
+    max_time : float
+        The longest interval, in seconds
+    recognizer : RecognizerBackend
+        The recognizer, Google by default
+    max_workers : int
+        The number of recognizer requests in flight
+    cache : TranscriptionCache
+        If given, intervals already recognized are taken from the cache
+    queue_size : int
+        The size of the queues between the stages
+    planner : bool
+        If true, the intervals are planned from the whole speech mask with
+        plan_speech_intervals instead of interval_generator
+    max_duration : float
+        The longest planned interval, in seconds
+
+    Yields:
+    -------
+    the subtitles, in order
+    """
+    sample_rate = 16000
+    frame_duration = 10
+    backend = _backend(recognizer, cache, max_workers)
+    params = {
+        "pcm": {"sample_rate": sample_rate},
+        "mask": {"detector": detector, "aggressiveness": aggressiveness,
+                 "frame_duration": frame_duration},
+        "timestamps": {"window_duration": window_duration, "min_speech_ratio": min_speech_ratio},
+        "intervals": {"max_pause": max_pause, "max_time": max_time, "planner": planner,
+                      "max_duration": max_duration, "max_gap": MAX_GAP, "padding": PADDING},
+        "transcripts": {"recognizer": backend.name, "language": backend.language},
+    }
+    keys = store.keys(media_file, params)
+
+    # the stored artifacts that can be used, up to the first missing one
+    stored = {}
+    for stage, _ in STAGES:
+        artifact = store.load(media_file, stage, keys[stage])
+        if artifact is None:
+            break
+        stored[stage] = artifact
+
+    if "transcripts" in stored:
+        yield from stored["transcripts"]
+        return
+
+    outputs = {stage: [] for stage, _ in STAGES}
+
+    def tee(stage, items):
+        for item in items:
+            outputs[stage].append(item)
+            yield item
+
+    def plan(masks):
+        blocks = [mask for _, mask in masks]
+        mask = np.concatenate(blocks) if blocks else np.zeros(0, dtype=bool)
+        outputs["timestamps"] = speech_timestamps(mask, frame_duration, window_duration, min_speech_ratio)
+        return plan_speech_intervals(mask, audio_object, frame_duration, max_pause, max_duration,
+                                     outputs["timestamps"])[0]
+
+    spool = None
+    if "pcm" in stored:
+        audio_object = stored["pcm"]
+        chunks = [audio_object.samples]
+    else:
+        spool = PcmSpool(store.path(media_file, "pcm", keys["pcm"]) + ".part", sample_rate, 1)
+        audio_object = spool
+        chunks = spool.tee(FfmpegAudioStream(media_file, sample_rate, 1, ffmpeg).read_chunks())
+
+    try:
+        with Pipeline(queue_size) as pipeline:
+            if "mask" in stored:
+                masks = [(0, stored["mask"])]
+            else:
+                audio_chunks = pipeline.stage(iter, chunks, "ingest")
+                masks = pipeline.stage(
+                    lambda items: tee("mask", speech_masks(items, sample_rate, frame_duration,
+                                                           detector, aggressiveness)),
+                    audio_chunks, "vad")
+
+            if "intervals" in stored:
+                intervals = stored["intervals"]
+            elif planner:
+                intervals = pipeline.stage(lambda items: tee("intervals", plan(items)), masks, "planner")
+            else:
+                if "timestamps" in stored:
+                    timestamps = stored["timestamps"]
+                else:
+                    timestamps = pipeline.stage(
+                        lambda items: tee("timestamps", mask_timestamp_generator(
+                            items, frame_duration, window_duration, min_speech_ratio)),
+                        masks, "windows")
+                intervals = pipeline.stage(
+                    lambda items: tee("intervals", interval_generator(items, max_pause, max_time,
+                                                                      window_duration)),
+                    timestamps, "intervals")
+            subtitles = pipeline.stage(
+                lambda items: recognize_intervals(audio_object, items, backend, max_workers),
+                intervals, "recognition")
+
+            for subtitle in subtitles:
+                outputs["transcripts"].append(subtitle)
+                yield subtitle
+    finally:
+        if spool is not None:
+            spool.close()
+
+    if spool is not None:
+        store.move_pcm(media_file, keys["pcm"], spool.name)
+    if "mask" not in stored:
+        masks = [mask for _, mask in outputs["mask"]]
+        store.save(media_file, "mask", keys["mask"],
+                   np.concatenate(masks) if masks else np.zeros(0, dtype=bool))
+    for stage in ("timestamps", "intervals"):
+        if stage not in stored:
+            store.save(media_file, stage, keys[stage], outputs[stage])
+    # the intervals that failed for a transient reason are tried again next time,
+    # no speech in music or noise is a result like any other
+    if not any(len(entry) > 2 and is_transient(entry[2]) for entry in outputs["transcripts"]):
+        store.save(media_file, "transcripts", keys["transcripts"], outputs["transcripts"])
+
+def subtitle_stream(chunks, audio_object, sample_rate=16000, detector="webrtc", recognizer=None,
+                    max_workers=4, cache=None, queue_size=64):
+    """
+    Generates the subtitles as a pipeline of stages running at the same time
+
+    Ingest, speech detection, interval building and recognition run on
+    their own threads, connected by bounded queues. The subtitles are
+    yielded in order as soon as they are recognized, the caller is the
+    export stage.
+
+    Parameters:
+    ----------
+    chunks : iterable
+        The mono audio chunks at sample_rate
+    audio_object : StereoAudioFile or PcmSpool
+        The audio the intervals are taken from
+    sample_rate : int
+        The sample rate of the chunks
+    detector : str
+        The speech detector, see detect_audio_segment
+    recognizer : RecognizerBackend
+        The recognizer, Google by default
+    max_workers : int
+        The number of recognizer requests in flight
+    cache : TranscriptionCache
+        If given, intervals already recognized are taken from the cache
+    queue_size : int
+        The size of the queues between the stages
+
+    Yields:
+    -------
+    the subtitles, in order
+    """
+    backend = _backend(recognizer, cache, max_workers)
+
+    with Pipeline(queue_size) as pipeline:
+        audio_chunks = pipeline.stage(iter, chunks, "ingest")
+        timestamps = pipeline.stage(
+            lambda items: speech_timestamp_generator(items, sample_rate, detector=detector),
+            audio_chunks, "vad")
+        intervals = pipeline.stage(interval_generator, timestamps, "intervals")
+        subtitles = pipeline.stage(
+            lambda items: recognize_intervals(audio_object, items, backend, max_workers),
+            intervals, "recognition")
+
+        yield from subtitles
+
+def _backend(recognizer, cache, max_workers=4):
+    if recognizer is None:
+        recognizer = GoogleBackend()
+    if not isinstance(recognizer, ResilientBackend):
+        # the recognizer threads are the most requests that can be in flight
+        recognizer = ResilientBackend(recognizer, initial_concurrency=max_workers,
+                                      max_concurrency=max_workers)
+    if cache is not None:
+        recognizer = CachedBackend(recognizer, cache)
+
+    return recognizer
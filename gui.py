@@ -1,16 +1,28 @@
-import tkinter
 from tkinter import *
 import cv2
-import PIL.Image, PIL.ImageTk
-from time import sleep
+from time import sleep, perf_counter
 import os
 from tkinter import filedialog
 import engine
+from artifacts import ArtifactStore
+from cache import TranscriptionCache
 import customtkinter
 import subprocess
+import queue
+import threading
 import pygame
-from subhelper import export_subtitiles
+from subhelper import SubtitleIndex, SubtitleWriter
+from renderer import SubtitleRenderer
+from display import FrameDisplay
 from videostream import VideoStream
+from metrics import METRICS
+
+FFMPEG = os.path.join(".", "ffmpeg", "bin", "ffmpeg")
+MEDIA_DIR = "media"
+SUBS_FILE = os.path.join("output", "subs.srt")
+METRICS_FILE = os.path.join("output", "metrics.prom")
+ARTIFACTS_DIR = os.path.join(MEDIA_DIR, "artifacts")
+CACHE_FILE = os.path.join("output", "transcriptions.sqlite")
 
 customtkinter.set_appearance_mode("System")
 customtkinter.set_default_color_theme("dark-blue")
@@ -38,15 +50,13 @@ class App:
         self.left_frame = customtkinter.CTkFrame(self.window, fg_color="transparent")
         self.left_frame.grid(row = 0, column=0)
 
-        # extracting the subtitles
-        command = ".\\ffmpeg\\bin\\ffmpeg -i " + self.video_file + " -ab 160k -ac 2 -ar 44100 -vn media\\raw_audio.wav"
-        subprocess.call(command, shell = True)
-        pygame.mixer.music.load("media\\raw_audio.wav")
+        # the audio for playback is extracted on a worker, the window opens meanwhile
+        self.playback_ready = threading.Event()
+        self.playback_error = None
+        self.playing = False
+        self.playback_worker = threading.Thread(target=self._extract_playback_audio, daemon=True)
+        self.playback_worker.start()
 
-        # Play the audio file
-        self.subs = engine.generate_subtitles(".\\media\\raw_audio.wav")
-        export_subtitiles(self.subs)
-        
         # setting up all the objects for video playing
         self.video = VideoStream(self.video_file)
 
@@ -54,11 +64,18 @@ class App:
         frame_count = int(self.video.vid.get(cv2.CAP_PROP_FRAME_COUNT))
         self.duration = frame_count/fps
 
+        # extracting the subtitles on a worker, they are picked up by update
+        self.subs = SubtitleIndex()
+        self.subs_queue = queue.Queue()
+        self.subs_worker = threading.Thread(target=self._generate_subtitles, daemon=True)
+        self.subs_worker.start()
+
         self.video_frame = customtkinter.CTkFrame(self.left_frame, fg_color="black")
         self.canvas = Canvas(self.video_frame, width = self.video.width, height = self.video.height, background="black", borderwidth=2)
 
         self._initialize_subtitles_params()
         
+        self.display = FrameDisplay(self.canvas, self.video.width, self.video.height)
         self.canvas.grid(row = 0, column = 0)
         self.subtitle_controls_frame = customtkinter.CTkFrame(self.window, fg_color="transparent")
         self.video_controls_frame = customtkinter.CTkFrame(self.left_frame, fg_color="transparent")
@@ -70,19 +87,47 @@ class App:
 
         self.video_frame.grid(row = 0, column = 0)
 
-        self.delay = (int) ((1 / self.video.vid.get(cv2.CAP_PROP_FPS)) * 1000)
-
+        self.video.start()
         self.update()
 
-        pygame.mixer.music.play()
         self.window.mainloop()
 
+    def _extract_playback_audio(self):
+        """
+        Runs on the worker thread and writes a compressed copy of the audio,
+        only used for playback. The playback starts in update once it is done.
+        """
+        playback_file = os.path.join(MEDIA_DIR, "playback.ogg")
+        try:
+            subprocess.run([FFMPEG, "-y", "-loglevel", "error", "-i", self.video_file,
+                            "-vn", "-ac", "2", "-c:a", "libvorbis", "-q:a", "4", playback_file], check=True)
+            self.playback_file = playback_file
+        except Exception as error:
+            self.playback_error = error
+        self.playback_ready.set()
+
+    def _start_playback(self):
+        """
+        Starts the audio, on the Tk thread, once the worker extracted it.
+        The video follows the audio clock, so it waits on its first frame
+        until then.
+        """
+        if self.playing or not self.playback_ready.is_set():
+            return
+        self.playing = True
+
+        if self.playback_error is not None:
+            self.sync_label.configure(text = "Audio failed")
+            return
+        pygame.mixer.music.load(self.playback_file)
+        pygame.mixer.music.play()
+        if self.paused == 1:
+            pygame.mixer.music.pause()
+
     def _initialize_subtitles_params(self):
         """
         Sets the initial values for the subtitles
         """
-        self.cursor = 0
-
         # initial state
         self.paused = 0
         self.cc_active = 0
@@ -91,6 +136,12 @@ class App:
         self.x_pos_sub = (int) (self.video.width / 2)
         self.y_pos_sub = (int) (self.video.height * 0.9)
         self.color = (0, 0, 0)
+        self.renderer = SubtitleRenderer()
+
+        self.fps_frames = 0
+        self.fps_start = perf_counter()
+        # the subtitle and its style on the frame shown last
+        self.shown_caption = None
 
     def _configure_subs_buttons(self):
         """
@@ -103,7 +154,8 @@ class App:
         self.yellow = customtkinter.CTkButton(self.subtitle_controls_frame, command=self.set_yellow, text="", fg_color="yellow", width=50)
         self.black = customtkinter.CTkButton(self.subtitle_controls_frame, command=self.set_black, text="", fg_color="black", width=50)
 
-        self.size_scale = customtkinter.CTkSlider(self.subtitle_controls_frame, from_=0, to=100, orientation="vertical", height=100)
+        self.size_scale = customtkinter.CTkSlider(self.subtitle_controls_frame, from_=0, to=100, orientation="vertical", height=100,
+                                                  command=self.set_size)
         self.size_scale.set(50)
 
         self.button_frame.grid(row = 0, column = 0, padx=2, pady=2)
@@ -140,6 +192,9 @@ class App:
         # these are for video control
         self.play_button.grid(row = 0, column = 0, padx=2, pady=2)
         self.progress_bar.grid(row = 0, column = 1, padx=2, pady=2)
+        self.subs_label.grid(row = 1, column = 0, padx=2, pady=2)
+        self.subs_progress.grid(row = 1, column = 1, padx=2, pady=2)
+        self.sync_label.grid(row = 2, column = 0, columnspan = 2, padx=2, pady=2)
 
     def _configure_video_buttons(self):
         """
@@ -151,6 +206,13 @@ class App:
 
         self.progress_bar = customtkinter.CTkProgressBar(self.video_controls_frame, orientation='horizontal',
                                          mode='determinate', )
+
+        self.subs_label = customtkinter.CTkLabel(self.video_controls_frame, text = "Subtitles:", fg_color="transparent")
+        self.subs_progress = customtkinter.CTkProgressBar(self.video_controls_frame, orientation='horizontal',
+                                         mode='determinate', )
+        self.subs_progress.set(0)
+
+        self.sync_label = customtkinter.CTkLabel(self.video_controls_frame, text = "", fg_color="transparent")
         
         self.button_frame = customtkinter.CTkFrame(self.subtitle_controls_frame, fg_color="transparent")
         
@@ -178,119 +240,116 @@ class App:
         self.left_image = PhotoImage(file = "./resources/left.png").subsample(14, 14)
         self.right_image = PhotoImage(file = "./resources/right.png").subsample(14, 14)
     
+    def _generate_subtitles(self):
+        """
+        Runs on the worker thread and publishes every subtitle as soon as it
+        is recognized, None when all are done. The subtitles are also written
+        to the srt file as they come, and the output of every stage is kept,
+        so opening the same file again does not compute it again. The
+        recognized intervals are also cached, so after a failed request only
+        the intervals without text are sent again.
+        """
+        try:
+            store = ArtifactStore(ARTIFACTS_DIR)
+            cache = TranscriptionCache(CACHE_FILE)
+            with SubtitleWriter(SUBS_FILE) as writer:
+                for subtitle in engine.stored_subtitle_stream(self.video_file, store, FFMPEG,
+                                                              cache=cache):
+                    writer.write(subtitle)
+                    self.subs_queue.put(subtitle)
+            self.subs_queue.put(None)
+        except Exception as error:
+            self.subs_queue.put(error)
+
+    def _receive_subtitles(self):
+        """
+        Takes the subtitles published by the worker, on the Tk thread
+        """
+        while True:
+            try:
+                item = self.subs_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            if item is None:
+                self.subs_progress.set(1)
+                self.subs_label.configure(text = "Subtitles ready")
+            elif isinstance(item, Exception):
+                self.subs_label.configure(text = "Subtitles failed")
+            else:
+                self.subs.insert(item)
+                self.subs_progress.set(min(item[0][1] / self.duration, 1))
+
     def update(self):
         """
         Updates the video frame
         """
-        if self.paused == 0:
-            ret, frame = self.video.get_frame()
-
-            font = cv2.FONT_HERSHEY_COMPLEX
-
-            if ret:
-                time = self.video.vid.get(cv2.CAP_PROP_POS_MSEC) / 1000
-                
-                if ((time / 1000) / self.duration) * 1000 > 0.99:
-                    self.window.destroy()
-                
-                self.progress_bar.set(((time / 1000) / self.duration) * 1000)
-                string = ""
-
-                if self.cursor < len(self.subs):
-                    if time < self.subs[self.cursor][0][0]:
-                        # I have not reached the window
-                        string = ""
-                    if time > self.subs[self.cursor][0][0] and time < self.subs[self.cursor][0][1]:
-                        # I am in the widow
-                        string = self.subs[self.cursor][1]
-                    if time > self.subs[self.cursor][0][1]:
-                        string = ""
-                        self.cursor = self.cursor + 1
+        self._receive_subtitles()
+        self._start_playback()
+
+        delay = 1 / self.video.fps
 
+        if self.paused == 0:
+            # the video follows the audio clock, late frames are dropped
+            time = max(pygame.mixer.music.get_pos() / 1000, 0)
+            repeated = self.video.repeated
+            frame = self.video.frame_at(time)
+            repeated = self.video.repeated != repeated
+
+            if self.video.finished or (time / self.duration) > 0.99:
+                self.video.stop()
+                if METRICS.enabled:
+                    METRICS.dump(METRICS_FILE)
+                self.window.destroy()
+                return
+
+            if frame is not None:
+                self.progress_bar.set(time / self.duration)
+                string = self.subs.find(time)
+
+                caption = None
                 if self.cc_active == 1 and string != "":
-                    final_size = 2 * (self.size_scale.get() / 100)
-                    whole_text_size = cv2.getTextSize(string, font, final_size, 2)[0][0]
-
-                    if whole_text_size < self.video.width:
-
-                        x_offset = (int) (cv2.getTextSize(string, font, final_size, 2)[0][0] / 2)
-
-                        x = self.x_pos_sub - x_offset
-                        y = self.y_pos_sub
-
-                        if self.bg_active:
-                            overlay = frame.copy()
-                            w = (int) (cv2.getTextSize(string, font, final_size, 2)[0][0])
-                            h = (int) ( - cv2.getTextSize(string, font, final_size, 2)[0][1] * 1.5)
-                            y = y -  (int) (h / 5)
-                            cv2.rectangle(overlay, (x, y), (x+w, y+h), (200, 200, 200), -1)  
-  
-                            alpha = 0.4 
-
-                            frame = cv2.addWeighted(overlay, alpha, frame, 1 - alpha, 0)
-
-                        cv2.putText(frame, string, (x, y), font, final_size, self.color, 2, cv2.LINE_4)
-                    else:
-                        # there are 2 rows
-                        # divide the string
-                        x = string.split()
-                        string1 = x[0]
-                        i = 1
-                        while i < len(x):
-                            string1 = string1 + " " + x[i]
-                            i = i + 1
-                            if cv2.getTextSize(string1, font, final_size, 2)[0][0] > (whole_text_size / 2):
-                                break
-                        string2 = x[i]
-                        i = i + 1
-
-                        while i < len(x):
-                            string2 = string2 + " " + x[i]
-                            i = i + 1
-                        
-                        # for the first string
-                        x_offset1 = (int) (cv2.getTextSize(string1, font, final_size, 2)[0][0] / 2)
-
-                        x1 = self.x_pos_sub - x_offset1
-                        y11 = self.y_pos_sub
-
-                        if self.bg_active:
-                            overlay = frame.copy()
-                            w1 = (int) (cv2.getTextSize(string1, font, final_size, 2)[0][0])
-                            h1 = (int) ( - cv2.getTextSize(string1, font, final_size, 2)[0][1] * 1.5)
-                            y12 = y11 -  (int) (h1 / 5)
-                            cv2.rectangle(overlay, (x1, y12), (x1+w1, y12+h1), (200, 200, 200), -1)  
-  
-                            alpha = 0.4 
-
-                            frame = cv2.addWeighted(overlay, alpha, frame, 1 - alpha, 0)
-
-                        cv2.putText(frame, string1, (x1, y11), font, final_size, self.color, 2, cv2.LINE_4)
-
-                        # for the second string
-                        x_offset2 = (int) (cv2.getTextSize(string2, font, final_size, 2)[0][0] / 2)
-
-                        x2 = self.x_pos_sub - x_offset2
-                        y21 = self.y_pos_sub - (int) ( - cv2.getTextSize(string1, font, final_size, 2)[0][1] * 1.5)
-
-                        if self.bg_active:
-                            overlay = frame.copy()
-                            w2 = (int) (cv2.getTextSize(string2, font, final_size, 2)[0][0])
-                            h2 = (int) ( - cv2.getTextSize(string2, font, final_size, 2)[0][1] * 1.5)
-                            y22 = y21 -  (int) (h2 / 5) + 5
-                            cv2.rectangle(overlay, (x2, y22), (x2+w2, y22+h2), (200, 200, 200), -1)  
-  
-                            alpha = 0.4 
-
-                            frame = cv2.addWeighted(overlay, alpha, frame, 1 - alpha, 0)
-
-                        cv2.putText(frame, string2, (x2, y21), font, final_size, self.color, 2, cv2.LINE_4)
-                        
-
-                self.photo = PIL.ImageTk.PhotoImage(image = PIL.Image.fromarray(frame))
-                self.canvas.create_image(0, 0, image = self.photo, anchor = tkinter.NW)
-        self.window.after(self.delay, self.update)
+                    # in the order of the arguments of SubtitleRenderer.render
+                    caption = (string, self.x_pos_sub, self.y_pos_sub, 2 * (self.size_scale.get() / 100),
+                               self.color, self.bg_active)
+
+                # a frame shown again with the same subtitle is already on the canvas
+                if not repeated or caption != self.shown_caption:
+                    with METRICS.span("gui_render"):
+                        draw = None
+                        if caption is not None:
+                            # drawn in the buffer of the display, the frame can be shown again
+                            draw = lambda image: self.renderer.render(image, *caption)
+                        self.display.show(frame, draw)
+                    self.shown_caption = caption
+                self._count_frame()
+
+            sync = "Dropped: %d  A/V: %+d ms" % (self.video.dropped, self.video.av_offset * 1000)
+            if not self.playing:
+                sync = "Loading audio..."
+            if self.playback_error is None and sync != self.sync_label.cget("text"):
+                self.sync_label.configure(text = sync)
+
+            delay = self.video.next_delay(time)
+
+        self.window.after(max(1, (int) (delay * 1000)), self.update)
     
+    def _count_frame(self):
+        """
+        Counts the frames shown and updates the frame rate once a second
+        """
+        if not METRICS.enabled:
+            return
+
+        METRICS.count("gui_frames")
+        self.fps_frames += 1
+        now = perf_counter()
+        if now - self.fps_start >= 1:
+            METRICS.set("gui_fps", self.fps_frames / (now - self.fps_start))
+            METRICS.set("gui_dropped_frames", self.video.dropped)
+            self.fps_frames = 0
+            self.fps_start = now
+
     def playpause(self):
         if self.paused == 0:
             self.paused = 1
@@ -325,14 +384,20 @@ class App:
     def move_left(self):
         self.x_pos_sub = self.x_pos_sub - 10
     
+    def set_size(self, value):
+        self.renderer.clear()
+
     def set_white(self):
         self.color = (255, 255, 255)
+        self.renderer.clear()
     
     def set_yellow(self):
         self.color = (255, 255, 0)
+        self.renderer.clear()
 
     def set_black(self):
         self.color = (0, 0, 0)
+        self.renderer.clear()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,274 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTE_BUCKETS = (4096, 16384, 65536, 131072, 262144, 524288, 1048576, 4194304)
+
+class Histogram:
+    """
+    Class used for counting observations in cumulative buckets, as in the
+    Prometheus histograms
+    """
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Parameters:
+        -----------
+        bounds : tuple
+            The upper bounds of the buckets, sorted
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value) -> None:
+        """
+        Adds an observation
+
+        Parameters:
+        -----------
+        value : float
+            The observed value
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list:
+        """
+        Returns:
+        --------
+        list : the bounds, with "+Inf" last, and the number of observations
+        up to every bound
+        """
+        total = 0
+        buckets = []
+        for bound, count in zip(list(self.bounds) + ["+Inf"], self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+class _Span:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe("stage_seconds", time.perf_counter() - self.start, stage=self.name)
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Metrics:
+    """
+    Class used for collecting the timings and the counters of a run
+
+    The time spent in every stage is measured with spans, which go to the
+    stage_seconds histogram labeled with the stage. Counters only go up,
+    gauges keep the last value set. Everything can be dumped as json or
+    in the Prometheus text format.
+
+    When disabled every call returns at once, and span returns a shared
+    object that does nothing, so the instrumentation can stay in the hot
+    paths.
+    """
+    def __init__(self, enabled=False, prefix="subgen"):
+        """
+        Parameters:
+        -----------
+        enabled : bool
+            If false nothing is recorded
+        prefix : str
+            Put before every name in the Prometheus format
+        """
+        self.enabled = enabled
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forgets everything recorded
+        """
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def span(self, name):
+        """
+        Measures the time of a stage, used as a context manager
+
+        Parameters:
+        -----------
+        name : str
+            The name of the stage
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def count(self, name, value=1, **labels) -> None:
+        """
+        Adds to a counter
+
+        Parameters:
+        -----------
+        name : str
+            The name of the counter
+        value : float
+            The amount added
+        labels :
+            The labels of the counter
+        """
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels) -> None:
+        """
+        Sets a gauge
+
+        Parameters:
+        -----------
+        name : str
+            The name of the gauge
+        value : float
+            The value
+        labels :
+            The labels of the gauge
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels) -> None:
+        """
+        Adds an observation to a histogram
+
+        Parameters:
+        -----------
+        name : str
+            The name of the histogram
+        value : float
+            The observed value
+        buckets : tuple
+            The bounds of the buckets, used when the histogram is created
+        labels :
+            The labels of the histogram
+        """
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+        --------
+        dict : the counters, the gauges and the histograms, with the labels
+        written as in the Prometheus format
+        """
+        with self._lock:
+            return {
+                "counters": {_name(key): value for key, value in self.counters.items()},
+                "gauges": {_name(key): value for key, value in self.gauges.items()},
+                "histograms": {_name(key): {"count": histogram.count, "sum": histogram.sum,
+                                            "buckets": [[bound, count] for bound, count
+                                                        in histogram.cumulative()]}
+                               for key, histogram in self.histograms.items()},
+            }
+
+    def to_json(self) -> str:
+        """
+        Returns:
+        --------
+        str : everything recorded, as json
+        """
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Returns:
+        --------
+        str : everything recorded, in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({key[0] for key in values}):
+                    full_name = self.prefix + "_" + name
+                    lines.append("# TYPE %s %s" % (full_name, kind))
+                    for key in sorted(key for key in values if key[0] == name):
+                        lines.append("%s %s" % (_name(key, full_name), _number(values[key])))
+
+            for name in sorted({key[0] for key in self.histograms}):
+                full_name = self.prefix + "_" + name
+                lines.append("# TYPE %s histogram" % full_name)
+                for key in sorted(key for key in self.histograms if key[0] == name):
+                    histogram = self.histograms[key]
+                    for bound, count in histogram.cumulative():
+                        labels = key[1] + (("le", str(bound)),)
+                        lines.append("%s %d" % (_name((name, labels), full_name + "_bucket"), count))
+                    lines.append("%s %s" % (_name(key, full_name + "_sum"), _number(histogram.sum)))
+                    lines.append("%s %d" % (_name(key, full_name + "_count"), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, file_name) -> None:
+        """
+        Writes everything recorded, in the Prometheus format for a .prom
+        file and as json otherwise
+
+        Parameters:
+        -----------
+        file_name : str
+            The file to write
+        """
+        text = self.to_prometheus() if file_name.endswith(".prom") else self.to_json()
+        with open(file_name, "w") as f:
+            f.write(text)
+
+def _key(name, labels) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+def _name(key, full_name=None) -> str:
+    name, labels = key
+    if full_name is None:
+        full_name = name
+    if not labels:
+        return full_name
+    return full_name + "{" + ",".join('%s="%s"' % (label, str(value).replace('"', '\\"'))
+                                      for label, value in labels) + "}"
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# the metrics of the process, enabled by setting SUBGEN_METRICS
+METRICS = Metrics(enabled=bool(os.environ.get("SUBGEN_METRICS")))
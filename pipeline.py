@@ -0,0 +1,103 @@
+import queue
+import threading
+
+class _Failure:
+    """
+    Carries the exception of a stage to the stages after it
+    """
+    def __init__(self, error):
+        self.error = error
+
+_DONE = object()
+
+class Pipeline:
+    """
+    Class used for running generators as stages on their own threads
+
+    Every stage is connected to the next one by a bounded queue, so a fast
+    stage only runs a few items ahead of a slow one and the total time
+    approaches the time of the slowest stage. An exception in a stage is
+    raised again in the stages after it.
+    """
+    def __init__(self, queue_size=64):
+        """
+        Parameters:
+        -----------
+        queue_size : int
+            The number of items a stage can run ahead of the next one
+        """
+        self.queue_size = queue_size
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def stage(self, function, items, name=None):
+        """
+        Starts a stage
+
+        Parameters:
+        -----------
+        function : callable
+            Takes an iterable of items and returns an iterable of results
+        items : iterable
+            The input of the stage, usually the output of the previous one
+        name : str
+            The name of the thread
+
+        Returns:
+        --------
+        generator : the results of the stage
+        """
+        output = queue.Queue(self.queue_size)
+
+        def run():
+            try:
+                for result in function(items):
+                    if not self._put(output, result):
+                        return
+                self._put(output, _DONE)
+            except BaseException as error:
+                self._put(output, _Failure(error))
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+        return self._drain(output)
+
+    def _put(self, output, item) -> bool:
+        while not self._stopped.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _drain(self, output):
+        while True:
+            try:
+                item = output.get(timeout=0.1)
+            except queue.Empty:
+                if self._stopped.is_set():
+                    return
+                continue
+
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def stop(self) -> None:
+        """
+        Stops all the stages and waits for their threads
+        """
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,308 @@
+import numpy as np
+
+def frame_energy(samples, frame_length, block_frames=65536) -> np.ndarray:
+    """
+    Computes the mean square of every frame
+
+    Parameters:
+    -----------
+    samples : ndarray
+        The mono int16 samples
+    frame_length : int
+        The number of samples in a frame
+    block_frames : int
+        The number of frames converted to float at once
+
+    Returns:
+    --------
+    ndarray : the energy of every complete frame
+    """
+    n_frames = len(samples) // frame_length
+    frames = np.asarray(samples[:n_frames * frame_length]).reshape(n_frames, frame_length)
+
+    energy = np.empty(n_frames, dtype=np.float64)
+    for start in range(0, n_frames, block_frames):
+        block = frames[start:start + block_frames].astype(np.float32)
+        energy[start:start + block_frames] = np.einsum("ij,ij->i", block, block) / frame_length
+
+    return energy
+
+def speech_runs(mask, max_pause_frames, min_speech_frames) -> list:
+    """
+    Finds the runs of speech in a frame mask
+
+    Parameters:
+    -----------
+    mask : ndarray
+        True for the frames that are speech
+    max_pause_frames : int
+        The runs separated by at most this many frames are joined
+    min_speech_frames : int
+        The joined runs with fewer speech frames are dropped as noise
+
+    Returns:
+    --------
+    list : the runs as [first frame, frame after the last one]
+    """
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8), [0]))))
+    starts = edges[0::2]
+    ends = edges[1::2]
+
+    runs = []
+    speech = 0
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if runs and start - runs[-1][1] <= max_pause_frames:
+            runs[-1][1] = end
+        else:
+            if runs and speech < min_speech_frames:
+                runs.pop()
+            runs.append([start, end])
+            speech = 0
+        speech += end - start
+    if runs and speech < min_speech_frames:
+        runs.pop()
+
+    return runs
+
+def trim_run(run, energy, silence_ratio=0.01) -> list:
+    """
+    Trims the quiet frames the speech detector keeps at the edges of a run
+
+    Parameters:
+    -----------
+    run : list
+        The first frame and the frame after the last one
+    energy : ndarray
+        The energy of every frame
+    silence_ratio : float
+        The frames quieter than this part of the median energy of the run
+        are silence
+
+    Returns:
+    --------
+    list : the trimmed run
+    """
+    start, end = run
+    run_energy = energy[start:min(end, len(energy))]
+    if len(run_energy) == 0:
+        return run
+
+    loud = np.flatnonzero(run_energy > silence_ratio * np.median(run_energy))
+    if len(loud) == 0:
+        return run
+
+    return [start + int(loud[0]), start + int(loud[-1]) + 1]
+
+def split_run(run, energy, max_frames) -> list:
+    """
+    Splits a long run at its quietest frames
+
+    The run is split in as few pieces as possible, and every cut is made
+    at the frame with the lowest energy around the place where the pieces
+    would have the same length, which is usually a pause between words.
+
+    Parameters:
+    -----------
+    run : list
+        The first frame and the frame after the last one
+    energy : ndarray
+        The energy of every frame
+    max_frames : int
+        The longest piece
+
+    Returns:
+    --------
+    list : the pieces
+    """
+    start, end = run
+    pieces = []
+    while end - start > max_frames:
+        n_pieces = -(-(end - start) // max_frames)
+        target = start + (end - start) // n_pieces
+        # the rest must still fit in the other pieces
+        low = max(end - (n_pieces - 1) * max_frames, target - max_frames // 4, start + 1)
+        high = min(start + max_frames, target + max_frames // 4, len(energy) - 1)
+        if high < low:
+            cut = target
+        else:
+            cut = low + int(np.argmin(energy[low:high + 1]))
+        pieces.append([start, cut])
+        start = cut
+    pieces.append([start, end])
+
+    return pieces
+
+def coalesce(runs, max_gap_frames, max_frames, joint_frames) -> list:
+    """
+    Groups neighbouring runs into one request while it stays short enough
+
+    The silence between the runs of a group is not sent, the runs are
+    joined by joint_frames of silence instead.
+
+    Parameters:
+    -----------
+    runs : list
+        The runs, in order
+    max_gap_frames : int
+        The longest silence between two runs of a group
+    max_frames : int
+        The longest request, with the joints
+    joint_frames : int
+        The silence put between two runs of a group
+
+    Returns:
+    --------
+    list : the groups, every group a list of runs
+    """
+    groups = []
+    length = 0
+    for start, end in runs:
+        if (groups and start - groups[-1][-1][1] <= max_gap_frames
+                and length + joint_frames + end - start <= max_frames):
+            groups[-1].append([start, end])
+            length += joint_frames + end - start
+        else:
+            groups.append([[start, end]])
+            length = end - start
+
+    return groups
+
+def interval_seconds(interval) -> float:
+    """
+    Computes the length of the audio sent for an interval
+
+    Parameters:
+    -----------
+    interval : list
+        [start, end] in seconds, or [start, end, parts] for the intervals
+        made of more parts
+
+    Returns:
+    --------
+    float : the length in seconds
+    """
+    if len(interval) > 2:
+        parts = interval[2]
+        return sum(end - start for start, end in parts) + (len(parts) - 1) * JOINT_SILENCE
+    return interval[1] - interval[0]
+
+# the silence between the parts of an interval, in seconds
+JOINT_SILENCE = 0.2
+# the longest silence between two runs sent in one request, in seconds
+MAX_GAP = 1.0
+# the silence kept on each side of a run, in seconds, the edges with energy are kept anyway
+PADDING = 0.0
+
+def split_text(text, parts) -> list:
+    """
+    Shares the words recognized for an interval between its parts, in
+    proportion to their lengths, so every part can be shown at its own time
+
+    Parameters:
+    -----------
+    text : str
+        The text of the whole interval
+    parts : list
+        The [start, end] of the parts
+
+    Returns:
+    --------
+    list : the text of every part, empty for a part that gets no word
+    """
+    words = text.split()
+    bounds = np.cumsum([end - start for start, end in parts])
+    texts = [[] for _ in parts]
+    for i, word in enumerate(words):
+        position = (i + 0.5) / len(words) * bounds[-1]
+        texts[min((int) (np.searchsorted(bounds, position)), len(parts) - 1)].append(word)
+
+    return [" ".join(words) for words in texts]
+
+def plan_intervals(mask, energy, frame_duration=10, max_pause=0.5, min_speech=0.15, max_duration=8.0,
+                   max_gap=MAX_GAP, padding=PADDING) -> list:
+    """
+    Plans the intervals sent to the recognizer from the speech mask
+
+    The intervals are trimmed to the speech frames and to the frames with
+    energy at their edges, so the silence around the speech is not
+    uploaded. Long runs are split at their quietest
+    frames, and short neighbouring runs are sent in one request without
+    the silence between them. The parts of such a request keep their own
+    times, see split_text, so the subtitles are not shown over the
+    silence that was left out.
+
+    Parameters:
+    -----------
+    mask : ndarray
+        True for the frames that are speech
+    energy : ndarray
+        The energy of every frame, see frame_energy
+    frame_duration : int
+        The frame duration in milliseconds
+    max_pause : float
+        The longest pause inside a run of speech, in seconds
+    min_speech : float
+        The runs with less speech are dropped, in seconds
+    max_duration : float
+        The longest audio sent in a request, in seconds
+    max_gap : float
+        The longest silence between two runs sent in one request, in seconds
+    padding : float
+        The silence kept on each side of a run, in seconds
+
+    Returns:
+    --------
+    list : the intervals, as [start, end] in seconds, or as [start, end,
+    parts] when more runs are sent together, parts being their [start, end]
+    """
+    frames_per_second = 1000 / frame_duration
+    pad = (int) (round(padding * frames_per_second))
+    max_frames = (int) (max_duration * frames_per_second)
+
+    runs = speech_runs(mask, (int) (round(max_pause * frames_per_second)),
+                       (int) (round(min_speech * frames_per_second)))
+    runs = [trim_run(run, energy) for run in runs]
+
+    # the padding is taken from the silence around the runs, without overlapping
+    padded = []
+    for start, end in runs:
+        start = max(start - pad, padded[-1][1] if padded else 0)
+        padded.append([start, min(end + pad, len(mask))])
+
+    pieces = [piece for run in padded for piece in split_run(run, energy, max_frames)]
+    groups = coalesce(pieces, (int) (round(max_gap * frames_per_second)), max_frames,
+                      (int) (round(JOINT_SILENCE * frames_per_second)))
+
+    intervals = []
+    for group in groups:
+        parts = [[start / frames_per_second, end / frames_per_second] for start, end in group]
+        if len(parts) == 1:
+            intervals.append(parts[0])
+        else:
+            intervals.append([parts[0][0], parts[-1][1], parts])
+
+    return intervals
+
+def compare_plans(intervals, baseline) -> dict:
+    """
+    Compares the requests and the uploaded audio of two interval plans
+
+    Parameters:
+    -----------
+    intervals : list
+        The planned intervals
+    baseline : list
+        The intervals of the current planner, generate_intervals
+
+    Returns:
+    --------
+    dict : the requests and audio seconds of both, and what was saved
+    """
+    seconds = sum(interval_seconds(interval) for interval in intervals)
+    baseline_seconds = sum(interval_seconds(interval) for interval in baseline)
+
+    return {"requests": len(intervals), "baseline_requests": len(baseline),
+            "requests_saved": len(baseline) - len(intervals),
+            "audio_seconds": round(seconds, 3), "baseline_audio_seconds": round(baseline_seconds, 3),
+            "audio_seconds_saved": round(baseline_seconds - seconds, 3)}
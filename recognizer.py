@@ -0,0 +1,230 @@
+import io
+import json
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+import speech_recognition as sr
+from metrics import BYTE_BUCKETS, METRICS
+
+# the encodings of the audio posted to a recognizer, with their content type
+ENCODINGS = {"wav": "audio/wav", "flac": "audio/x-flac"}
+
+def encode_audio(audio, encoding="flac") -> bytes:
+    """
+    Encodes the audio of an interval for sending it to a recognizer
+
+    Parameters:
+    -----------
+    audio : AudioData
+        The audio of the interval
+    encoding : str
+        "flac", lossless and about half the size of the speech as wav, or
+        "wav"
+
+    Returns:
+    --------
+    bytes : the encoded audio
+    """
+    with METRICS.span("payload_encode"):
+        if encoding == "flac":
+            return audio.get_flac_data()
+        if encoding == "wav":
+            return audio.get_wav_data()
+    raise ValueError("unknown encoding " + encoding)
+
+def post_audio(url, data, headers, timeout) -> bytes:
+    """
+    Posts the encoded audio of an interval to a recognizer
+
+    The size of every request goes to the recognizer_request_bytes
+    histogram and the upload time to recognizer_upload_seconds. The upload
+    time is the time until the answer starts, less the processing time the
+    server reports in a Server-Timing header. A server that does not
+    report it has its processing time counted as upload.
+
+    Parameters:
+    -----------
+    url : str
+        The address of the recognizer
+    data : bytes
+        The encoded audio
+    headers : dict
+        The headers of the request
+    timeout : float
+        The time to wait for an answer, in seconds
+
+    Returns:
+    --------
+    bytes : the body of the answer
+    """
+    parts = urlsplit(url)
+    path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+    connection_class = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+    connection = connection_class(parts.netloc, timeout=timeout)
+    try:
+        start = time.perf_counter()
+        connection.request("POST", path, body=data, headers=headers)
+        response = connection.getresponse()
+        elapsed = time.perf_counter() - start
+
+        processing = sum(float(duration) / 1000 for duration
+                         in re.findall(r"dur=([0-9.]+)", response.headers.get("Server-Timing", "")))
+        METRICS.observe("recognizer_upload_seconds", max(elapsed - processing, 0))
+        METRICS.observe("recognizer_request_bytes", len(data), buckets=BYTE_BUCKETS)
+        METRICS.count("recognizer_upload_bytes", len(data))
+
+        body = response.read()
+        if response.status >= 400:
+            # the same error as urllib raises, so the client can classify it
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return body
+    finally:
+        connection.close()
+
+class RecognizerBackend:
+    """
+    Base class for the speech recognizers used by the engine
+
+    A backend turns the audio of an interval into text and raises an
+    exception when it can not.
+    """
+    name = "base"
+
+    def __init__(self, language="en-US"):
+        """
+        Parameters:
+        -----------
+        language : str
+            The language of the speech
+        """
+        self.language = language
+
+    def recognize(self, audio) -> str:
+        """
+        Recognizes the speech
+
+        Parameters:
+        -----------
+        audio : AudioData
+            The audio of the interval
+
+        Returns:
+        --------
+        str : the text
+        """
+        raise NotImplementedError
+
+class GoogleBackend(RecognizerBackend):
+    """
+    The Google Speech Recognition API
+
+    The request is made by speech_recognition, so its size and upload time
+    are not measured, only HttpBackend reports them.
+    """
+    name = "google"
+
+    def __init__(self, language="en-US", operation_timeout=30):
+        """
+        Parameters:
+        -----------
+        language : str
+            The language of the speech
+        operation_timeout : float
+            The time to wait for an answer, in seconds
+        """
+        super().__init__(language)
+        self.operation_timeout = operation_timeout
+
+    def recognize(self, audio) -> str:
+        recognizer = sr.Recognizer()
+        recognizer.operation_timeout = self.operation_timeout
+        return recognizer.recognize_google(audio, language=self.language)
+
+class SphinxBackend(RecognizerBackend):
+    """
+    CMU Sphinx, runs offline but needs pocketsphinx installed
+    """
+    name = "sphinx"
+
+    def recognize(self, audio) -> str:
+        return sr.Recognizer().recognize_sphinx(audio, language=self.language)
+
+class HttpBackend(RecognizerBackend):
+    """
+    A recognizer reached over plain HTTP, the audio is posted as a flac or
+    wav file and the answer is a json object with a "text" field
+    """
+    name = "http"
+
+    def __init__(self, url, language="en-US", timeout=30, encoding="flac"):
+        """
+        Parameters:
+        -----------
+        url : str
+            The address of the recognizer
+        language : str
+            The language of the speech
+        timeout : float
+            The time to wait for an answer, in seconds
+        encoding : str
+            The encoding of the posted audio, see ENCODINGS
+        """
+        super().__init__(language)
+        if encoding not in ENCODINGS:
+            raise ValueError("unknown encoding " + encoding)
+        self.url = url
+        self.timeout = timeout
+        self.encoding = encoding
+
+    def recognize(self, audio) -> str:
+        data = encode_audio(audio, self.encoding)
+        body = post_audio(self.url, data, {"Content-Type": ENCODINGS[self.encoding],
+                                           "Content-Language": self.language}, self.timeout)
+        return json.loads(body)["text"]
+
+BACKENDS = {
+    GoogleBackend.name: GoogleBackend,
+    SphinxBackend.name: SphinxBackend,
+    HttpBackend.name: HttpBackend,
+}
+
+def map_ordered(function, items, max_workers=4):
+    """
+    Calls function for every item on a thread pool
+
+    At most max_workers calls run at once and the results are yielded in
+    the order of the items, as soon as they are ready. A few more items
+    than workers are queued so that a slow call does not leave the other
+    workers idle.
+
+    Parameters:
+    -----------
+    function : callable
+        The function to call
+    items : iterable
+        The arguments, can be a generator
+    max_workers : int
+        The number of concurrent calls
+
+    Yields:
+    -------
+    the results of function, in order
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_COMPLEX
+THICKNESS = 2
+BG_COLOR = (200, 200, 200)
+BG_ALPHA = 0.4
+
+class Sprite:
+    """
+    Class used for modeling a rendered subtitle
+    """
+    __slots__ = ("x", "y", "color", "inverse_alpha")
+
+    def __init__(self, x, y, color, inverse_alpha):
+        """
+        Parameters:
+        -----------
+        x : int
+            The horizontal offset of the sprite from the subtitle position
+        y : int
+            The vertical offset of the sprite from the subtitle position
+        color : ndarray
+            The color of every pixel, already multiplied by its alpha
+        inverse_alpha : ndarray
+            How much of the frame is kept under every pixel
+        """
+        self.x = x
+        self.y = y
+        self.color = color
+        self.inverse_alpha = inverse_alpha
+
+class SubtitleRenderer:
+    """
+    Class used for drawing subtitles on video frames
+
+    Every subtitle is laid out and rasterized once into a sprite with
+    alpha, which is then blended only over the part of the frame it covers.
+    """
+    def __init__(self, max_sprites=32):
+        """
+        Parameters:
+        -----------
+        max_sprites : int
+            The number of sprites kept in the cache
+        """
+        self.max_sprites = max_sprites
+        self.sprites = OrderedDict()
+
+    def clear(self) -> None:
+        """
+        Empties the cache, used when the size or the color changes
+        """
+        self.sprites.clear()
+
+    def render(self, frame, text, x, y, size, color, bg) -> None:
+        """
+        Draws a subtitle on the frame
+
+        Parameters:
+        -----------
+        frame : ndarray
+            The frame, changed in place
+        text : str
+            The subtitle
+        x : int
+            The horizontal center of the subtitle
+        y : int
+            The baseline of the first row
+        size : float
+            The font scale
+        color : tuple
+            The text color
+        bg : bool
+            If true, the text has a translucent background
+        """
+        key = (text, size, color, bool(bg), frame.shape[1])
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = self._rasterize(text, size, color, bg, frame.shape[1])
+            self.sprites[key] = sprite
+            if len(self.sprites) > self.max_sprites:
+                self.sprites.popitem(last=False)
+        else:
+            self.sprites.move_to_end(key)
+
+        _blend(frame, sprite, x + sprite.x, y + sprite.y)
+
+    def _rasterize(self, text, size, color, bg, max_width) -> Sprite:
+        texts, rects = layout(text, size, max_width)
+
+        # bounds of everything that is drawn, relative to the subtitle position
+        boxes = [(x0, y0, x1, y1) for x0, y0, x1, y1 in rects]
+        for string, x, y in texts:
+            (w, h), baseline = cv2.getTextSize(string, FONT, size, THICKNESS)
+            boxes.append((x - THICKNESS, y - h - THICKNESS, x + w + THICKNESS, y + baseline + THICKNESS))
+        left = min(box[0] for box in boxes)
+        top = min(box[1] for box in boxes)
+        width = max(box[2] for box in boxes) - left + 1
+        height = max(box[3] for box in boxes) - top + 1
+
+        bg_mask = np.zeros((height, width), dtype=np.uint8)
+        if bg:
+            for x0, y0, x1, y1 in rects:
+                cv2.rectangle(bg_mask, (x0 - left, y0 - top), (x1 - left, y1 - top), 255, -1)
+
+        text_mask = np.zeros((height, width), dtype=np.uint8)
+        for string, x, y in texts:
+            cv2.putText(text_mask, string, (x - left, y - top), FONT, size, 255, THICKNESS, cv2.LINE_4)
+
+        is_text = text_mask > 0
+        alpha = np.where(is_text, 1.0, (bg_mask > 0) * BG_ALPHA).astype(np.float32)[:, :, None]
+        colors = np.where(is_text[:, :, None], np.float32(color), np.float32(BG_COLOR))
+
+        return Sprite(left, top, colors * alpha, 1 - alpha)
+
+def layout(text, size, max_width) -> tuple:
+    """
+    Splits the subtitle in one or two rows and places them
+
+    The positions are relative to the horizontal center and the baseline
+    of the first row.
+
+    Parameters:
+    -----------
+    text : str
+        The subtitle
+    size : float
+        The font scale
+    max_width : int
+        The width of the frame
+
+    Returns:
+    --------
+    tuple : the rows as (text, x, y) and the background rectangles as
+    (x0, y0, x1, y1)
+    """
+    whole_text_size = _width(text, size)
+    words = text.split()
+
+    rows = [text]
+    if whole_text_size >= max_width and len(words) > 1:
+        # the first row gets the words up to half of the width
+        i = 1
+        while i < len(words) - 1 and _width(" ".join(words[:i]), size) <= whole_text_size / 2:
+            i = i + 1
+        rows = [" ".join(words[:i]), " ".join(words[i:])]
+
+    texts = []
+    rects = []
+    y = 0
+    for n, row in enumerate(rows):
+        (w, h), _ = cv2.getTextSize(row, FONT, size, THICKNESS)
+        x = - (int) (w / 2)
+        rect_h = (int) (- h * 1.5)
+        rect_y = y - (int) (rect_h / 5) + (5 if n > 0 else 0)
+
+        texts.append((row, x, y))
+        rects.append((x, min(rect_y, rect_y + rect_h), x + w, max(rect_y, rect_y + rect_h)))
+        y = y - rect_h
+
+    return texts, rects
+
+def _width(text, size) -> int:
+    return cv2.getTextSize(text, FONT, size, THICKNESS)[0][0]
+
+def _blend(frame, sprite, x, y) -> None:
+    height, width = sprite.inverse_alpha.shape[:2]
+
+    # only the part of the sprite inside the frame is blended
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + width, frame.shape[1])
+    y1 = min(y + height, frame.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    roi = frame[y0:y1, x0:x1]
+    inverse_alpha = sprite.inverse_alpha[y0 - y:y1 - y, x0 - x:x1 - x]
+    color = sprite.color[y0 - y:y1 - y, x0 - x:x1 - x]
+
+    roi[:] = (roi * inverse_alpha + color).astype(np.uint8)
@@ -0,0 +1,218 @@
+import argparse
+import io
+import json
+import random
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StandInServer:
+    """
+    A local HTTP server that stands in for the speech recognizer
+
+    It answers every posted wav or flac file after a fixed latency, with a
+    text describing the audio it got. With a bandwidth the time taken to
+    upload the file over a slow link is added to the latency. Used with recognizer.HttpBackend for
+    testing and benchmarking without the network.
+
+    Failures can be injected: a part of the requests is answered with
+    server errors, throttled with 429 or never answered in time, and the
+    requests over the capacity are throttled, like a real service does
+    under load.
+    """
+    def __init__(self, latency=0.5, host="127.0.0.1", port=0, jitter=0.0, error_rate=0.0,
+                 throttle_rate=0.0, timeout_rate=0.0, hang=30.0, capacity=None, retry_after=None,
+                 seed=None, bandwidth=None):
+        """
+        Parameters:
+        -----------
+        latency : float
+            The time taken by every request, in seconds
+        host : str
+            The address to listen on
+        port : int
+            The port to listen on, 0 picks a free one
+        jitter : float
+            A random time up to this is added to the latency, in seconds
+        error_rate : float
+            The part of the requests answered with 503
+        throttle_rate : float
+            The part of the requests answered with 429
+        timeout_rate : float
+            The part of the requests answered only after hang seconds
+        hang : float
+            The latency of the requests that time out, in seconds
+        capacity : int
+            The requests in flight over this number are answered with 429
+        retry_after : float
+            If given, the 429 answers ask to wait this long, in seconds
+        seed : int
+            The seed of the injected failures
+        bandwidth : float
+            If given, the uplink of the clients in bytes per second
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.received_bytes = 0
+        self.answered = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _make_handler(self))
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://" + host + ":" + str(port) + "/recognize"
+
+    def start(self) -> None:
+        """
+        Starts serving on a background thread
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def serve(self) -> None:
+        """
+        Serves on the current thread until interrupted
+        """
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            self._server.server_close()
+
+    def stop(self) -> None:
+        """
+        Stops the server
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def answer(self, body) -> tuple:
+        """
+        Builds the answer for a request
+
+        Parameters:
+        -----------
+        body : bytes
+            The posted wav or flac file
+
+        Returns:
+        --------
+        tuple : the status code, the json answer and the processing time in
+        seconds, without the simulated upload
+        """
+        with self._lock:
+            self.requests += 1
+            self.received_bytes += len(body)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            over_capacity = self.capacity is not None and self.in_flight > self.capacity
+            draw = self._random.random()
+            latency = self.latency + self._random.uniform(0, self.jitter)
+
+        if self.bandwidth:
+            # the body only arrives once the slow uplink has sent it
+            time.sleep(len(body) / self.bandwidth)
+        start = time.perf_counter()
+        try:
+            if over_capacity or draw < self.throttle_rate:
+                status, answer = 429, {"error": "too many requests"}
+            elif draw < self.throttle_rate + self.error_rate:
+                time.sleep(latency)
+                status, answer = 503, {"error": "unavailable"}
+            else:
+                if draw < self.throttle_rate + self.error_rate + self.timeout_rate:
+                    latency = self.hang
+                time.sleep(latency)
+
+                duration = _duration(body)
+                status, answer = 200, {"text": "speech of %.2f seconds" % duration}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+        with self._lock:
+            self.answered[status] = self.answered.get(status, 0) + 1
+
+        return status, answer, time.perf_counter() - start
+
+def _duration(body) -> float:
+    if body[:4] == b"fLaC":
+        # the stream info block comes first, with the rate and the number of samples
+        if len(body) < 26:
+            raise EOFError
+        info = int.from_bytes(body[18:26], "big")
+        return (info & ((1 << 36) - 1)) / (info >> 44)
+
+    with wave.open(io.BytesIO(body)) as wav_file:
+        return wav_file.getnframes() / wav_file.getframerate()
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 refuses connections under high concurrency
+    request_queue_size = 128
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                status, answer, processing = server.answer(body)
+            except (ZeroDivisionError, wave.Error, EOFError):
+                status, answer, processing = 400, {"error": "not a wav or flac file"}, 0
+
+            data = json.dumps(answer).encode()
+            self.send_response(status)
+            if status == 429 and server.retry_after is not None:
+                self.send_header("Retry-After", str(server.retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Server-Timing", "recognize;dur=%.3f" % (processing * 1000))
+            self.send_header("Content-Length", str(len(data)))
+            try:
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client gave up waiting, as with the injected timeouts
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the speech recognizer")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="the part of the requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="the part of the requests answered with 429")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="the part of the requests that hang")
+    parser.add_argument("--capacity", type=int, help="the requests in flight over this are answered with 429")
+    parser.add_argument("--bandwidth", type=float, help="the uplink of the clients in bytes per second")
+    args = parser.parse_args()
+
+    server = StandInServer(args.latency, port=args.port, jitter=args.jitter, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, timeout_rate=args.timeout_rate,
+                           capacity=args.capacity, bandwidth=args.bandwidth)
+    print("Listening on " + server.url)
+    server.serve()
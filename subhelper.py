@@ -1,22 +1,174 @@
-def export_subtitiles(subs : list) -> None:
-    """ Saves subtitles in the srt format
+from bisect import bisect_right
 
-    Writes the subtitles in the output/subs.srt file
+class SubtitleIndex:
+    """
+    Class used for finding the subtitle shown at a given time
+
+    The subtitles are kept sorted by their starting time, so the lookup is
+    a binary search and works after any seek. The intervals of the
+    subtitles are not expected to overlap.
+    """
+    def __init__(self, subs=()):
+        """
+        Parameters:
+        -----------
+        subs : iterable
+            The initial subtitles, as [interval, text] entries
+        """
+        self.starts = []
+        self.entries = []
+        for entry in subs:
+            self.insert(entry)
+
+    def insert(self, entry) -> None:
+        """
+        Adds a subtitle, in any order
+
+        Parameters:
+        -----------
+        entry : list
+            The interval and the text of the subtitle
+        """
+        start = entry[0][0]
+        position = bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.entries.insert(position, entry)
+
+    def find(self, time) -> str:
+        """
+        Finds the subtitle shown at a time
+
+        Parameters:
+        -----------
+        time : float
+            The time in seconds
+
+        Returns:
+        --------
+        str : the text, empty if there is no subtitle at that time
+        """
+        position = bisect_right(self.starts, time) - 1
+        if position < 0:
+            return ""
+
+        entry = self.entries[position]
+        if time < entry[0][1]:
+            return entry[1]
+        return ""
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+def format_timestamp(seconds, separator=",") -> str:
+    """
+    Formats a time as HH:MM:SS,mmm
+
+    Parameters:
+    -----------
+    seconds : float
+        The time in seconds
+    separator : str
+        The separator of the milliseconds, "," for srt and "." for WebVTT
+
+    Returns:
+    --------
+    str : the formatted time
+    """
+    milliseconds = max((int) (round(seconds * 1000)), 0)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+
+    return "%02d:%02d:%02d%s%03d" % (hours, minutes, seconds, separator, milliseconds)
+
+FORMATS = ("srt", "vtt")
+
+class SubtitleWriter:
+    """
+    Class used for writing subtitles to a file as they are generated
+
+    Every subtitle is appended as a cue as soon as it is written and the
+    file is flushed regularly, so the subtitles written so far survive a
+    crash and the file can be followed while a long job runs. Subtitles
+    without text are skipped.
+    """
+    def __init__(self, file_name, format=None, flush_every=1):
+        """
+        Parameters:
+        -----------
+        file_name : str
+            The subtitle file
+        format : str
+            "srt" or "vtt", taken from the extension of the file by default
+        flush_every : int
+            The number of cues written between two flushes
+        """
+        if format is None:
+            format = "vtt" if file_name.lower().endswith(".vtt") else "srt"
+        if format not in FORMATS:
+            raise ValueError("Unknown subtitle format " + str(format))
+
+        self.file_name = file_name
+        self.format = format
+        self.flush_every = flush_every
+        self.index = 0
+
+        self._file = open(file_name, "w", encoding="utf-8")
+        if format == "vtt":
+            self._file.write("WEBVTT\n\n")
+            self._file.flush()
+
+    def write(self, entry) -> None:
+        """
+        Appends a subtitle
+
+        Parameters:
+        -----------
+        entry : list
+            The interval and the text of the subtitle
+        """
+        interval, text = entry[0], entry[1]
+        if text == "":
+            return
+
+        self.index += 1
+        separator = "." if self.format == "vtt" else ","
+        self._file.write("%d\n%s --> %s\n%s\n\n" % (self.index,
+                                                     format_timestamp(interval[0], separator),
+                                                     format_timestamp(interval[1], separator),
+                                                     text))
+        if self.index % self.flush_every == 0:
+            self._file.flush()
+
+    def close(self) -> None:
+        """
+        Flushes and closes the file
+        """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def export_subtitiles(subs : list, file_name="output/subs.srt") -> None:
+    """ Saves subtitles in the srt format, or WebVTT for a .vtt file
+
+    Writes the subtitles in the output/subs.srt file by default
     
     Parameters
     ----------
     subs: list
         The subtitles to be saved
+    file_name: str
+        The subtitle file
 
     """
 
-    f = open("output/subs.srt", "w")
-    index = 1
-    for entry in subs:
-        if entry[1] == "":
-            continue
-        f.write(str(index) + "\n")
-        f.write("00:" + str(entry[0][0]) + ":00 -->" + "00:" + str(entry[0][1]) + ":00\n")
-        f.write(entry[1] + "\n\n")
-        index += 1
-    f.close()
\ No newline at end of file
+    with SubtitleWriter(file_name) as writer:
+        for entry in subs:
+            writer.write(entry)
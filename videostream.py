@@ -0,0 +1,153 @@
+import queue
+import threading
+import cv2
+
+_END = object()
+
+class VideoStream:
+    """
+    Class used for reading the frames of a video
+
+    The frames can be read one by one with get_frame, or decoded ahead on a
+    thread into a bounded buffer after start, and then taken with frame_at
+    for the current playback time.
+    """
+    def __init__(self, video_source, buffer_size=8):
+        """
+        Parameters:
+        -----------
+        video_source : str
+            The video file
+        buffer_size : int
+            The number of frames decoded ahead of playback
+        """
+        self.vid = cv2.VideoCapture(video_source)
+        if not self.vid.isOpened():
+            raise ValueError("Unable to open video source " + str(video_source))
+
+        self.width = self.vid.get(cv2.CAP_PROP_FRAME_WIDTH)
+        self.height = self.vid.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        self.fps = self.vid.get(cv2.CAP_PROP_FPS) or 25
+
+        self.buffer_size = buffer_size
+        self.dropped = 0
+        self.repeated = 0
+        self.av_offset = 0
+        self.finished = False
+
+        self._frames = queue.Queue(buffer_size)
+        self._stopped = threading.Event()
+        self._thread = None
+        self._current = None
+        self._current_shown = False
+        self._next = None
+
+    def get_frame(self):
+        """
+        Reads the next frame
+
+        Returns:
+        --------
+        tuple : true if a frame was read, and the frame in RGB
+        """
+        ret, frame = self.vid.read()
+        if ret:
+            return ret, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        return ret, None
+
+    def start(self) -> None:
+        """
+        Starts decoding the frames ahead on a thread
+        """
+        self._thread = threading.Thread(target=self._decode, daemon=True)
+        self._thread.start()
+
+    def _decode(self):
+        while not self._stopped.is_set():
+            ret, frame = self.get_frame()
+            if not ret:
+                self._put(_END)
+                return
+            pts = self.vid.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            self._put((pts, frame))
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def frame_at(self, clock):
+        """
+        Takes the frame to show at a playback time
+
+        The frames that are already late are dropped, and the last frame is
+        shown again when the next one is not due yet.
+
+        Parameters:
+        -----------
+        clock : float
+            The playback time in seconds, usually the audio position
+
+        Returns:
+        --------
+        ndarray : the frame in RGB, None before the first one is decoded
+        """
+        while not self.finished:
+            if self._next is None:
+                try:
+                    self._next = self._frames.get_nowait()
+                except queue.Empty:
+                    # the decoder is behind, the last frame is shown again
+                    break
+
+            if self._next is _END:
+                self.finished = True
+                break
+
+            if self._next[0] > clock + 0.5 / self.fps:
+                break
+
+            if self._current is not None and not self._current_shown:
+                self.dropped += 1
+            self._current = self._next
+            self._current_shown = False
+            self._next = None
+
+        if self._current is None:
+            return None
+
+        if self._current_shown:
+            self.repeated += 1
+        self._current_shown = True
+        self.av_offset = self._current[0] - clock
+
+        return self._current[1]
+
+    def next_delay(self, clock) -> float:
+        """
+        Computes the time until the next frame is due
+
+        Parameters:
+        -----------
+        clock : float
+            The playback time in seconds
+
+        Returns:
+        --------
+        float : the delay in seconds
+        """
+        if self._next is not None and self._next is not _END:
+            return max(self._next[0] - clock, 0)
+        return 1 / self.fps
+
+    def stop(self) -> None:
+        """
+        Stops the decoding thread and releases the video
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.vid.release()